@@ -10,6 +10,13 @@ import cStringIO as StringIO
 import os
 import logging
 import random
+import struct
+import threading
+import Queue
+import multiprocessing.pool
+import hashlib
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
 
 
 class HBaseMapper(object):
@@ -24,6 +31,98 @@ class HBaseMapper(object):
             self._hbase[row] = out
 
 
+def split_slice(start_row, stop_row, num_slices):
+    """Splits [start_row, stop_row) into at most num_slices contiguous sub-slices
+
+    Split points are spread evenly over the two bytes after the common prefix
+    of start_row and stop_row (e.g., md5 rows in an upload prefix split evenly).
+    """
+    prefix = os.path.commonprefix([start_row, stop_row])
+
+    def value(row):
+        return struct.unpack('>H', row[len(prefix):len(prefix) + 2].ljust(2, '\0'))[0]
+    low, high = value(start_row), value(stop_row)
+    rows = set(prefix + struct.pack('>H', low + (high - low) * x // num_slices) for x in range(1, num_slices))
+    rows = [start_row] + sorted(x for x in rows if start_row < x < stop_row) + [stop_row]
+    return zip(rows[:-1], rows[1:])
+
+
+def _length_prefixed_records(chunks):
+    # Yields each record of a stream of 4 byte big endian length + record, chunks are decoded
+    # content (e.g., from iter_content) so they may split records anywhere
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= 4:
+            size = struct.unpack('>I', str(buf[:4]))[0]
+            if len(buf) < 4 + size:
+                break
+            record = str(buf[4:4 + size])
+            del buf[:4 + size]
+            yield record
+    if buf:
+        raise IOError('picarus_api: truncated export')
+
+
+class DiskCache(object):
+    """Size bounded LRU cache of responses on disk, each entry is (etag, content_type, content)
+
+    Entries are files named by the key, the least recently used (by mtime) are removed
+    once the total size is over max_bytes.  Safe to share between threads.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._sizes = dict((x, os.path.getsize(os.path.join(path, x))) for x in os.listdir(path) if not x.endswith('.tmp'))
+
+    def key(self, *args):
+        return hashlib.sha1(json.dumps(args, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        fn = os.path.join(self.path, key)
+        try:
+            with open(fn, 'rb') as fp:
+                header, content = fp.read().split('\n', 1)
+            os.utime(fn, None)
+        except (IOError, OSError, ValueError):
+            return None
+        etag, content_type = json.loads(header)
+        return etag, content_type, content
+
+    def put(self, key, etag, content_type, content):
+        fn = os.path.join(self.path, key)
+        tmp_fn = '%s.%d.tmp' % (fn, threading.current_thread().ident)
+        with open(tmp_fn, 'wb') as fp:
+            fp.write(json.dumps([etag, content_type]) + '\n')
+            fp.write(content)
+        os.rename(tmp_fn, fn)
+        with self._lock:
+            self._sizes[key] = os.path.getsize(fn)
+            if sum(self._sizes.values()) > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        mtimes = []
+        for x in self._sizes:
+            try:
+                mtimes.append((os.path.getmtime(os.path.join(self.path, x)), x))
+            except OSError:
+                mtimes.append((0, x))
+        total_bytes = sum(self._sizes.values())
+        for _, x in sorted(mtimes):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, x))
+            except OSError:
+                pass
+            total_bytes -= self._sizes.pop(x)
+
+
 class FatalErrorStatus(Exception):
     """Return status that cannot be retried"""
 
@@ -57,26 +156,63 @@ def retry(func):
 
 class PicarusClient(object):
 
-    def __init__(self, email, api_key=None, login_key=None, server="https://api.picar.us", max_attempts=5):
+    def __init__(self, email, api_key=None, login_key=None, server="https://api.picar.us", max_attempts=5, use_msgpack=True,
+                 pool_size=10, cache_dir=None, cache_size=1024 ** 3):
         self.email = email
         self.api_key = api_key
         self.login_key = login_key
         self.server = server
         self.version = 'v0'
         import requests
+        import requests.adapters
         self.requests = requests
+        # Connections are kept alive and reused, the session may be shared by threads (pool_size connections per host)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
         self.timeout = 3600  # 60 min
         self.max_attempts = max_attempts
         self.attempt_sleep = 1.
-
-    def _check_status(self, response):
+        # Row/column data is requested as msgpack (binary values) instead of JSON (base64 values)
+        self.msgpack = None
+        self._data_headers = {}
+        if use_msgpack:
+            try:
+                import msgpack
+                self.msgpack = msgpack
+                self._data_headers = {'Accept': MSGPACK_CONTENT_TYPE}
+            except ImportError:
+                logging.warn('picarus_api: msgpack not available, using json')
+        # If set, row data GETs (get_row/get_slice/get_table) are cached and revalidated by ETag
+        self.cache = DiskCache(cache_dir, cache_size) if cache_dir else None
+
+    def _check_status_code(self, response):
         if response.status_code in (502, 503, 429, 408):
             raise ErrorStatus('picarus_api: returned [%d]' % (response.status_code))
         if response.status_code != 200:
             raise FatalErrorStatus('picarus_api: returned [%d][%s]' % (response.status_code, response.content[:64]))
-        return json.loads(response.content)
 
-    def _decode_lod(self, lod):
+    def _check_status(self, response):
+        return self._load(response)[0]
+
+    def _is_raw(self, response):
+        return response.headers.get('content-type', '').startswith(MSGPACK_CONTENT_TYPE)
+
+    def _load(self, response):
+        # Returns (value, raw) where raw is True if the values are binary (msgpack) and not base64
+        self._check_status_code(response)
+        return self._loads(response.headers.get('content-type', ''), response.content)
+
+    def _loads(self, content_type, content):
+        if content_type.startswith(MSGPACK_CONTENT_TYPE):
+            return self.msgpack.unpackb(content), True
+        return json.loads(content), False
+
+    def _decode_lod(self, lod, raw=False):
+        if raw:
+            return [(x.pop('row'), x) for x in lod]
         row_columns = []
         for x in lod:
             row = self.dec(x['row'])
@@ -103,33 +239,77 @@ class PicarusClient(object):
     @retry
     def get(self, path, data=None):
         path = '/'.join(map(urllib.quote_plus, path))
-        r = self.requests.get('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), params=data, timeout=self.timeout)
+        r = self.session.get('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), params=data, timeout=self.timeout)
         return self._check_status(r)
 
+    @retry
+    def get_data(self, path, data=None):
+        # Same as get but negotiates the row data format (and uses the cache), returns (value, raw)
+        path = '/'.join(map(urllib.quote_plus, path))
+        url = '%s/%s/%s' % (self.server, self.version, path)
+        headers = dict(self._data_headers)
+        cached = None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.email, url, data, headers)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+        r = self.session.get(url, auth=(self.email, self.api_key), params=data, timeout=self.timeout, headers=headers)
+        if cached is not None and r.status_code == 304:
+            return self._loads(cached[1], cached[2])
+        out = self._load(r)
+        if self.cache is not None and 'etag' in r.headers:
+            self.cache.put(cache_key, r.headers['etag'], r.headers.get('content-type', ''), r.content)
+        return out
+
+    @retry
+    def get_stream(self, path, data=None):
+        # Returns the response so the body can be read as it arrives
+        path = '/'.join(map(urllib.quote_plus, path))
+        r = self.session.get('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), params=data, timeout=self.timeout, stream=True, headers=self._data_headers)
+        self._check_status_code(r)
+        return r
+
     @retry
     def post(self, path, data=None):
         path = '/'.join(map(urllib.quote_plus, path))
-        r = self.requests.post('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, **self._split_data(data))
+        r = self.session.post('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, **self._split_data(data))
         return self._check_status(r)
 
+    @retry
+    def post_data(self, path, data=None):
+        # Same as post but negotiates the row data format, returns (value, raw)
+        path = '/'.join(map(urllib.quote_plus, path))
+        r = self.session.post('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, headers=self._data_headers, **self._split_data(data))
+        return self._load(r)
+
     @retry
     def post_login(self, path, data=None):
         path = '/'.join(map(urllib.quote_plus, path))
-        r = self.requests.post('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.login_key), timeout=self.timeout, **self._split_data(data))
+        r = self.session.post('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.login_key), timeout=self.timeout, **self._split_data(data))
         return self._check_status(r)
 
     @retry
     def delete(self, path, data=None):
         path = '/'.join(map(urllib.quote_plus, path))
-        r = self.requests.delete('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), data=data, timeout=self.timeout)
+        r = self.session.delete('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), data=data, timeout=self.timeout)
         return self._check_status(r)
 
     @retry
     def patch(self, path, data=None):
         path = '/'.join(map(urllib.quote_plus, path))
-        r = self.requests.patch('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, **self._split_data(data))
+        r = self.session.patch('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, **self._split_data(data))
         return self._check_status(r)
 
+    @retry
+    def patch_data(self, path, body):
+        # Sends a msgpack body as is, returns (value, raw)
+        path = '/'.join(map(urllib.quote_plus, path))
+        headers = dict(self._data_headers)
+        headers['Content-Type'] = MSGPACK_CONTENT_TYPE
+        r = self.session.patch('%s/%s/%s' % (self.server, self.version, path), auth=(self.email, self.api_key), timeout=self.timeout, headers=headers, data=body)
+        return self._load(r)
+
     def _encode_columns(self, columns):
         data = {}
         if columns is not None:
@@ -146,7 +326,7 @@ class PicarusClient(object):
     # /data/:table
 
     def get_table(self, table, columns=None):
-        return self._decode_lod(self.get(('data', table), data=self._encode_columns(columns)))
+        return self._decode_lod(*self.get_data(('data', table), data=self._encode_columns(columns)))
 
     def post_table(self, table, data=None):
         if data and 'slices' in data:
@@ -156,10 +336,10 @@ class PicarusClient(object):
     # /data/:table/:row
 
     def get_row(self, table, row, columns=None):
-        return self.decdict(self.get(('data', table, self.encurl(row)), data=self._encode_columns(columns)))
+        return self.decdict(*self.get_data(('data', table, self.encurl(row)), data=self._encode_columns(columns)))
 
     def post_row(self, table, row, data=None):
-        return self.decdict(self.post(('data', table, self.encurl(row)), data=self.encvalues(data)))
+        return self.decdict(*self.post_data(('data', table, self.encurl(row)), data=self.encvalues(data)))
 
     def delete_row(self, table, row):
         return self.delete(('data', table, self.encurl(row)))
@@ -170,13 +350,85 @@ class PicarusClient(object):
     def patch_row(self, table, row, data=None):
         return self.patch(('data', table, self.encurl(row)), data=self.encdict(data))
 
+    # /rows/:table
+
+    def get_rows(self, table, rows, columns=None):
+        # NOTE: Rows that don't exist are left out of the result
+        data = self._encode_columns(columns)
+        data['rows'] = ','.join(map(self.enc, rows))
+        return self._decode_lod(*self.post_data(('rows', table), data=data))
+
+    def patch_rows(self, table, row_columns):
+        # Writes many rows in one request, returns [(row, status), ...] where status is the HTTP code for that row
+        if self.msgpack is None:
+            raise ValueError('patch_rows requires msgpack')
+        packer = self.msgpack.Packer()
+        body = ''.join(packer.pack([row, columns]) for row, columns in row_columns)
+        out, raw = self.patch_data(('rows', table), body)
+        return [(x['row'] if raw else self.dec(x['row']), x['status']) for x in out]
+
     # /slice/:table/:start_row/:stop_row
 
     def get_slice(self, table, start_row, stop_row, columns=None, data=None):
         column_data = self._encode_columns(columns)
         if data is not None:
             column_data.update(data)
-        return self._decode_lod(self.get(('slice', table, self.encurl(start_row), self.encurl(stop_row)), data=column_data))
+        return self._decode_lod(*self.get_data(('slice', table, self.encurl(start_row), self.encurl(stop_row)), data=column_data))
+
+    def iter_slice(self, table, start_row, stop_row, columns=None, data=None):
+        # Streamed version of get_slice, rows are yielded as they are received
+        column_data = self._encode_columns(columns)
+        if data is not None:
+            column_data.update(data)
+        column_data['stream'] = '1'
+        r = self.get_stream(('slice', table, self.encurl(start_row), self.encurl(stop_row)), data=column_data)
+        if self._is_raw(r):
+            unpacker = self.msgpack.Unpacker()
+            for chunk in r.iter_content(65536):
+                unpacker.feed(chunk)
+                for x in unpacker:
+                    yield x.pop('row'), x
+            return
+        for line in r.iter_lines():
+            if line:
+                for row_columns in self._decode_lod([json.loads(line)]):
+                    yield row_columns
+
+    def _connection_errors(self):
+        return (IOError, self.requests.exceptions.RequestException, self.requests.packages.urllib3.exceptions.HTTPError)
+
+    def export_slice(self, table, start_row, stop_row, columns=None, data=None):
+        # Yields (row, columns) from a msgpack export, follows continuation tokens and resumes after
+        # the last row received if the connection drops
+        if self.msgpack is None:
+            raise ValueError('export_slice requires msgpack')
+        column_data = self._encode_columns(columns)
+        if data is not None:
+            column_data.update(data)
+        column_data['export'] = 'msgpack'
+        attempt = 0
+        while True:
+            r = self.get_stream(('slice', table, self.encurl(start_row), self.encurl(stop_row)), data=column_data)
+            continuation = None
+            try:
+                for record in _length_prefixed_records(r.iter_content(65536)):
+                    record = self.msgpack.unpackb(record)
+                    if isinstance(record, dict):
+                        continuation = record['continuation']
+                        break
+                    yield record[0], record[1]
+                    column_data['continuation'] = self.encurl(record[0])
+                    attempt = 0
+            except self._connection_errors():
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                logging.warn('picarus_api: export interrupted, resuming')
+                time.sleep(self.attempt_sleep * attempt)
+                continue
+            if continuation is None:
+                return
+            column_data['continuation'] = continuation
 
     def post_slice(self, table, start_row, stop_row, data=None):
         return self.decdict(self.post(('slice', table, self.encurl(start_row), self.encurl(stop_row)), data=self.encvalues(data)))
@@ -187,19 +439,99 @@ class PicarusClient(object):
     def delete_slice(self, table, start_row, stop_row):
         return self.delete(('slice', table, self.encurl(start_row), self.encurl(stop_row)))
 
-    def scanner(self, table, start_row, stop_row, columns=None, data=None):
+    def scanner(self, table, start_row, stop_row, columns=None, data=None, num_threads=1, prefetch=4):
+        """Yields (row, columns) in order for the slice
+
+        If num_threads > 1 then the slice is split into sub-slices that are downloaded
+        concurrently by background threads, each keeping up to prefetch batches of rows ahead.
+        """
+        if num_threads > 1:
+            return self._concurrent_scanner(table, start_row, stop_row, columns, data, num_threads, prefetch)
+        return self._scanner(table, start_row, stop_row, columns, data)
+
+    def _scanner(self, table, start_row, stop_row, columns=None, data=None):
         if data is None:
             data = {}
         if 'maxRows' not in data:
             data['maxRows'] = '10000'
+        attempt = 0
         while True:
-            row_columns = self.get_slice(table, start_row, stop_row, columns=columns, data=data)
-            if not row_columns:
+            # NOTE: If the connection drops mid-page we resume after the last row yielded
+            row = None
+            try:
+                for row, cur_columns in self.iter_slice(table, start_row, stop_row, columns=columns, data=data):
+                    yield row, cur_columns
+                    start_row = row
+                    data['excludeStart'] = '1'
+                    attempt = 0
+            except self._connection_errors():
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                logging.warn('picarus_api: slice interrupted, resuming')
+                time.sleep(self.attempt_sleep * attempt)
+                continue
+            if row is None:
                 break
-            for row, cur_columns in row_columns:
-                yield row, cur_columns
-            start_row = row
-            data['excludeStart'] = '1'
+
+    def _concurrent_scanner(self, table, start_row, stop_row, columns, data, num_threads, prefetch, batch_rows=100):
+        # NOTE: More sub-slices than threads so that a dense sub-slice doesn't hold up the rest
+        sub_slices = split_slice(start_row, stop_row, num_threads * 4)
+        outputs = [Queue.Queue(maxsize=prefetch) for _ in sub_slices]
+        tasks = Queue.Queue()
+        for task in enumerate(sub_slices):
+            tasks.put(task)
+        stopped = threading.Event()
+
+        def put(output, x):
+            # Gives up if the consumer stopped (it may never take from this queue again)
+            while not stopped.is_set():
+                try:
+                    output.put(x, timeout=1.)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def worker():
+            while not stopped.is_set():
+                try:
+                    num, (sub_start_row, sub_stop_row) = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    batch = []
+                    for row_columns in self._scanner(table, sub_start_row, sub_stop_row, columns, dict(data or {})):
+                        batch.append(row_columns)
+                        if len(batch) >= batch_rows:
+                            if not put(outputs[num], batch):
+                                return
+                            batch = []
+                    if not put(outputs[num], batch) or not put(outputs[num], None):
+                        return
+                except Exception, e:
+                    put(outputs[num], e)
+                    return
+        # NOTE: Workers take sub-slices in order, so the one being consumed has always been started
+        threads = [threading.Thread(target=worker) for _ in range(min(num_threads, len(sub_slices)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        def consume():
+            try:
+                for output in outputs:
+                    while True:
+                        batch = output.get()
+                        if batch is None:
+                            break
+                        if isinstance(batch, Exception):
+                            raise batch
+                        for row_columns in batch:
+                            yield row_columns
+            finally:
+                stopped.set()
+        return consume()
 
     def enc(self, x):
         return base64.b64encode(str(x))
@@ -232,9 +564,11 @@ class PicarusClient(object):
                 out[k] = self.enc(v)
         return out
 
-    def decdict(self, d):
+    def decdict(self, d, raw=False):
         if d is None:
             return {}
+        if raw:
+            return d
         return dict((self.dec(x), self.dec(y)) for x, y in d.items())
 
     def decvalues(self, d):
@@ -252,3 +586,45 @@ class PicarusClient(object):
             if status in ('completed', 'finished'):
                 return job_results
             time.sleep(delay)
+
+
+class PicarusClientAsync(object):
+    """Same methods as PicarusClient but requests return futures (multiprocessing.pool.AsyncResult, use .get())
+
+    At most max_concurrency requests run at once (each with the usual retry/backoff) and
+    calls block once max_pending requests are outstanding.  Generators (e.g., scanner) and
+    helpers are passed through to the underlying client unchanged.
+    """
+    _async_methods = set(['get', 'get_data', 'post', 'post_data', 'post_login', 'delete', 'patch', 'patch_data',
+                          'auth_email_api_key', 'auth_yubikey', 'get_table', 'post_table', 'get_row', 'post_row',
+                          'delete_row', 'delete_column', 'patch_row', 'get_rows', 'patch_rows', 'get_slice',
+                          'post_slice', 'patch_slice', 'delete_slice', 'watch_job'])
+
+    def __init__(self, *args, **kw):
+        max_concurrency = kw.pop('max_concurrency', 100)
+        max_pending = kw.pop('max_pending', 10 * max_concurrency)
+        kw.setdefault('pool_size', max_concurrency)
+        self.client = PicarusClient(*args, **kw)
+        self._pool = multiprocessing.pool.ThreadPool(max_concurrency)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def __getattr__(self, name):
+        func = getattr(self.client, name)
+        if name not in self._async_methods:
+            return func
+
+        def inner(*args, **kw):
+            self._pending.acquire()
+
+            def run():
+                try:
+                    return func(*args, **kw)
+                finally:
+                    self._pending.release()
+            return self._pool.apply_async(run)
+        return inner
+
+    def close(self):
+        # Waits for the outstanding requests
+        self._pool.close()
+        self._pool.join()
@@ -20,6 +20,10 @@ import logging
 import driver
 import tables
 import hashlib
+import collections
+import tarfile
+import zipfile
+import worker_pool
 try:
     from flickr_keys import FLICKR_API_KEY, FLICKR_API_SECRET
 except ImportError:
@@ -27,6 +31,74 @@ except ImportError:
     FLICKR_API_KEY, FLICKR_API_SECRET = '', ''
 
 
+# Evaluated in redis for a batch of rows so that only matching rows/columns are returned
+# KEYS: table:row for each row
+# ARGV: keys_only, filter_column, filter_relation, filter_value, columns...
+REDIS_GET_ROWS_LUA = """
+local keys_only = ARGV[1] == '1'
+local filter_column, filter_relation, filter_value = ARGV[2], ARGV[3], ARGV[4]
+local cols, cfs = {}, {}
+for i = 5, #ARGV do
+    if string.sub(ARGV[i], -1) == ':' then
+        cfs[ARGV[i]] = true
+    else
+        cols[ARGV[i]] = true
+    end
+end
+local out = {}
+for i, key in ipairs(KEYS) do
+    local keep = true
+    if filter_relation ~= '' then
+        local value = redis.call('HGET', key, filter_column)
+        if not value then
+            keep = false
+        elseif filter_relation == '=' then
+            keep = value == filter_value
+        elseif filter_relation == '!=' then
+            keep = value ~= filter_value
+        else
+            keep = string.sub(value, 1, #filter_value) == filter_value
+        end
+    end
+    local row = {}
+    if keep then
+        local names
+        if #ARGV > 4 then
+            names = {}
+            for _, k in ipairs(redis.call('HKEYS', key)) do
+                local cf = string.match(k, '^[^:]*:')
+                if cols[k] or (cf and cfs[cf]) then
+                    names[#names + 1] = k
+                end
+            end
+        elseif keys_only then
+            names = redis.call('HKEYS', key)
+        else
+            row = redis.call('HGETALL', key)
+        end
+        if names and #names > 0 then
+            if keys_only then
+                for _, k in ipairs(names) do
+                    row[#row + 1] = k
+                    row[#row + 1] = ''
+                end
+            else
+                local values = redis.call('HMGET', key, unpack(names))
+                for j, k in ipairs(names) do
+                    if values[j] then
+                        row[#row + 1] = k
+                        row[#row + 1] = values[j]
+                    end
+                end
+            end
+        end
+    end
+    out[i] = row
+end
+return out
+"""
+
+
 def _tempfile(data, suffix=''):
     fp = tempfile.NamedTemporaryFile(suffix=suffix)
     fp.write(data)
@@ -62,14 +134,76 @@ def async(func):
     return inner
 
 
-def factory(database, local, jobs, **kw):
+def archive_members(fp):
+    # Yields (name, data) for each file in a zip or tar (optionally compressed) without extracting to disk
+    if zipfile.is_zipfile(fp):
+        fp.seek(0)
+        archive = zipfile.ZipFile(fp)
+        for info in archive.infolist():
+            if not info.filename.endswith('/'):
+                yield info.filename, archive.read(info)
+        archive.close()
+        return
+    fp.seek(0)
+    archive = tarfile.open(fileobj=fp, mode='r|*')
+    for member in archive:
+        if member.isfile():
+            yield member.name, archive.extractfile(member).read()
+    archive.close()
+
+
+def factory(database, local, jobs, num_workers=1, **kw):
     if database == 'redis':
-        return RedisDB(kw['redis_host'], kw['redis_port'], 2, jobs, local)
-    if database == 'hbase':
-        return HBaseDB(kw['thrift_server'], kw['thrift_port'], jobs, local)
-    if database == 'hbasehadoop':
-        return HBaseDBHadoop(kw['thrift_server'], kw['thrift_port'], jobs, local)
-    raise ValueError('Unknown option[%s]' % database)
+        db = RedisDB(kw['redis_host'], kw['redis_port'], 2, jobs, local)
+    elif database == 'hbase':
+        db = HBaseDB(kw['thrift_server'], kw['thrift_port'], jobs, local)
+    elif database == 'hbasehadoop':
+        db = HBaseDBHadoop(kw['thrift_server'], kw['thrift_port'], jobs, local)
+    else:
+        raise ValueError('Unknown option[%s]' % database)
+    db.num_workers = num_workers
+    return db
+
+
+class Mutator(object):
+    """Buffers row mutations/deletes and sends them to the database in batches
+
+    Flushed when max_rows or max_bytes is reached, on flush(), and when used as
+    a context manager on exit.
+    """
+
+    def __init__(self, db, max_rows=1000, max_bytes=16 * 1024 ** 2):
+        self._db = db
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._mutations = []  # [(table, row, mutations)], mutations is None for deletes
+        self._byte_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def mutate_row(self, table, row, mutations):
+        self._mutations.append((table, row, mutations))
+        self._byte_count += len(row) + sum(len(x) + len(y) for x, y in mutations.items())
+        self._check_flush()
+
+    def delete_row(self, table, row):
+        self._mutations.append((table, row, None))
+        self._byte_count += len(row)
+        self._check_flush()
+
+    def _check_flush(self):
+        if len(self._mutations) >= self.max_rows or self._byte_count >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if self._mutations:
+            self._db._flush_mutations(self._mutations)
+        self._mutations = []
+        self._byte_count = 0
 
 
 class BaseDB(object):
@@ -81,30 +215,76 @@ class BaseDB(object):
             self.args = [jobs, True]
         self._jobs = jobs
         self._local = local
+        self.num_workers = 1  # Processes used by row jobs (e.g., exif, takeout chains) when not using Hadoop
         super(BaseDB, self).__init__()
 
     def __reduce__(self):
         return (BaseDB, tuple(self.args))
 
-    def _row_job(self, table, start_row, stop_row, input_column, output_column, func, job_row):
-        good_rows, total_rows = 0, 0
-        for row, columns in self.scanner(table, start_row, stop_row, columns=[input_column]):
-            total_rows += 1
+    def mutator(self, **kw):
+        return Mutator(self, **kw)
+
+    def close(self):
+        pass
+
+    def get_rows(self, table, rows, columns=None):
+        # Returns a list of column dicts in the order of rows ({} if the row doesn't exist)
+        # Backends override this to fetch the whole batch at once
+        out = []
+        for row in rows:
             try:
-                input_data = columns[input_column]
-            except KeyError:
-                continue
+                out.append(self.get_row(table, row, columns))
+            except bottle.HTTPError:
+                out.append({})
+        return out
+
+    def _flush_mutations(self, mutations):
+        # Backends override this to send the whole batch at once
+        for table, row, cur_mutations in mutations:
+            if cur_mutations is None:
+                self.delete_row(table, row)
+            else:
+                self.mutate_row(table, row, cur_mutations)
+
+    def _row_map(self, func, row_inputs):
+        # Yields (row, func(input_data)) in scan order, using num_workers processes when > 1
+
+        def safe_func(input_data):
+            if input_data is None:
+                return
             try:
-                output_data = func(input_data)
+                return func(input_data)
             except:
                 # TODO: We need some way of reporting exceptions back
-                continue
-            if output_data is None:
-                continue
-            self.mutate_row(table, row, {output_column: output_data})
-            good_rows += 1
-            self._jobs.update_task(job_row, {'goodRows': good_rows, 'badRows': total_rows - good_rows, 'status': 'running'})
-        self._jobs.update_task(job_row, {'goodRows': good_rows, 'badRows': total_rows - good_rows, 'status': 'completed'})
+                return
+        if self.num_workers <= 1:
+            for row, input_data in row_inputs:
+                yield row, safe_func(input_data)
+            return
+        rows = collections.deque()
+
+        def worker_inputs():
+            for row, input_data in row_inputs:
+                rows.append(row)
+                yield (input_data,)
+        with worker_pool.WorkerPool(self.num_workers, safe_func) as pool:
+            for output_data in pool.imap(worker_inputs()):
+                yield rows.popleft(), output_data
+
+    def _row_job(self, table, start_row, stop_row, input_column, output_column, func, job_row):
+        # Scan (prefetching a batch of rows) -> func (in the worker pool) -> batched writes
+        row_inputs = ((row, columns.get(input_column))
+                      for row, columns in self.scanner(table, start_row, stop_row, columns=[input_column],
+                                                       per_call=max(10, 2 * self.num_workers)))
+        with self._jobs.progress(job_row) as progress:
+            with self.mutator() as mutator:
+                for row, output_data in self._row_map(func, row_inputs):
+                    if output_data is None:
+                        progress.bad()
+                        continue
+                    mutator.mutate_row(table, row, {output_column: output_data})
+                    progress.good()
+            progress.finish()
 
     @async
     def exif_job(self, start_row, stop_row, job_row):
@@ -160,7 +340,6 @@ class BaseDB(object):
         except (KeyError, ValueError):
             bottle.abort(400, 'Invalid crawler parameters')
 
-        job_columns = {'goodRows': 0, 'badRows': 0, 'status': 'running'}
         row_latlon = {}  # [row] = [[lat, lon]]
 
         def store(crawl_kwargs, image, source, **kw):
@@ -177,14 +356,14 @@ class BaseDB(object):
                 row_latlon.setdefault(row, []).append([kw['latitude'], kw['longitude']])
             except KeyError:
                 pass
-            self.mutate_row('images', row, cols)
-            job_columns['goodRows'] += 1
-            self._jobs.update_task(job_row, job_columns)
-        crawlers.street_view_crawl(store, **p)
-        for row, latlons in row_latlon.items():
-            self.mutate_row('images', row, {'meta:latlons': json.dumps(latlons)})
-        job_columns['status'] = 'completed'
-        self._jobs.update_task(job_row, job_columns)
+            mutator.mutate_row('images', row, cols)
+            progress.good()
+        with self._jobs.progress(job_row) as progress:
+            with self.mutator() as mutator:
+                crawlers.street_view_crawl(store, **p)
+                for row, latlons in row_latlon.items():
+                    mutator.mutate_row('images', row, {'meta:latlons': json.dumps(latlons)})
+            progress.finish()
 
     @async
     def flickr_job(self, params, start_row, stop_row, job_row):
@@ -241,7 +420,6 @@ class BaseDB(object):
             p['page'] = int(params['page'])
         except KeyError:
             pass
-        job_columns = {'goodRows': 0, 'badRows': 0, 'status': 'running'}
 
         def store(crawl_kwargs, image, source, **kw):
             print('In store')
@@ -261,51 +439,77 @@ class BaseDB(object):
             for x, y in kw.items():
                 cols['meta:' + x] = y
             row = row_prefix + cur_md5
-            print('Pre mutate row')
-            self.mutate_row('images', row, cols)
-            print('Post mutate row')
-            job_columns['goodRows'] += 1
-            self._jobs.update_task(job_row, job_columns)
-
-        for n in range(iterations):
-            print('Iter[%d]' % n)
-            if upload_date_radius:
-                p['min_upload_date'] = random.randint(min_upload_date, max_upload_date - upload_date_radius)
-                p['max_upload_date'] = p['min_upload_date'] + upload_date_radius
-            crawlers.flickr_crawl(store, **p)
-        job_columns['status'] = 'completed'
-        self._jobs.update_task(job_row, job_columns)
+            mutator.mutate_row('images', row, cols)
+            progress.good()
+
+        with self._jobs.progress(job_row) as progress:
+            with self.mutator() as mutator:
+                for n in range(iterations):
+                    print('Iter[%d]' % n)
+                    if upload_date_radius:
+                        p['min_upload_date'] = random.randint(min_upload_date, max_upload_date - upload_date_radius)
+                        p['max_upload_date'] = p['min_upload_date'] + upload_date_radius
+                    crawlers.flickr_crawl(store, **p)
+            progress.finish()
+
+    def import_archive(self, fp, row_prefix, job_row):
+        # Each file becomes row_prefix + md5(file)
+        with self._jobs.progress(job_row) as progress:
+            try:
+                with self.mutator() as mutator:
+                    for name, data in archive_members(fp):
+                        if not data:
+                            progress.bad()
+                            continue
+                        cur_md5 = hashlib.md5(data).digest()
+                        mutator.mutate_row('images', row_prefix + cur_md5, {'data:image': data, 'hash:md5': cur_md5,
+                                                                            'meta:filename': name})
+                        progress.good()
+                        # NOTE: Lets other greenlets run between members when this runs in the server (local)
+                        time.sleep(0)
+            except (tarfile.TarError, zipfile.BadZipfile, IOError, EOFError):
+                # NOTE: Invalid or truncated (e.g., gzip/bz2) archive, the rows before the error are kept
+                progress.update({'status': 'failed'})
+                return
+            progress.finish()
+
+    @async
+    def import_archive_path_job(self, path, row_prefix, job_row, delete=False):
+        # If delete then the file (e.g., a spooled upload) is removed afterwards
+        try:
+            with open(path, 'rb') as fp:
+                self.import_archive(fp, row_prefix, job_row)
+        finally:
+            if delete:
+                os.remove(path)
 
     @async
     def create_model_job(self, create_model, params, inputs, schema, start_stop_rows, table, email, job_row):
         # Give the model creator an iterator of row, cols (where cols are the input names)
-        job_columns = {'goodRows': 0, 'badRows': 0, 'status': 'running'}
         os.nice(5)  # These are background tasks, don't let the CPU get too crazy
 
         def inner():
-            total_rows = 0
             for start_row, stop_row in start_stop_rows:
                 row_cols = self.scanner(table, columns=inputs.values(), start_row=start_row, stop_row=stop_row)
                 for row, columns in row_cols:
-                    total_rows += 1
                     try:
-                        yield row, dict((pretty_column, columns[raw_column]) for pretty_column, raw_column in inputs.items())
-                        job_columns['goodRows'] += 1
-                        job_columns['badRows'] = total_rows - job_columns['goodRows']
-                        self._jobs.update_task(job_row, job_columns)
+                        cur_columns = dict((pretty_column, columns[raw_column]) for pretty_column, raw_column in inputs.items())
                     except KeyError:
+                        progress.bad()
                         continue
-        input_type, output_type, model_link = create_model(inner(), params)
-        slices = [base64.b64encode(start_row) + ',' + base64.b64encode(stop_row) for start_row, stop_row in start_stop_rows]
-        inputsb64 = dict((k, base64.b64encode(v)) for k, v in inputs.items())
-        factory_info = {'slices': slices, 'num_rows': job_columns['goodRows'], 'data': 'slices', 'params': params, 'inputs': inputsb64}
-        manager = driver.PicarusManager(db=self)
-        model_chain = tables._takeout_model_chain_from_key(manager, inputs[input_type]) + [model_link]
-        job_columns['modelRow'] = manager.input_model_param_to_key(**{'input': inputs[input_type], 'model_link': model_link, 'model_chain': model_chain, 'input_type': input_type,
-                                                                      'output_type': output_type, 'email': email, 'name': manager.model_to_name(model_link),
-                                                                      'factory_info': json.dumps(factory_info)})
-        job_columns['status'] = 'completed'
-        self._jobs.update_task(job_row, job_columns)
+                    yield row, cur_columns
+                    progress.good()
+        with self._jobs.progress(job_row) as progress:
+            input_type, output_type, model_link = create_model(inner(), params)
+            slices = [base64.b64encode(start_row) + ',' + base64.b64encode(stop_row) for start_row, stop_row in start_stop_rows]
+            inputsb64 = dict((k, base64.b64encode(v)) for k, v in inputs.items())
+            factory_info = {'slices': slices, 'num_rows': progress.good_rows, 'data': 'slices', 'params': params, 'inputs': inputsb64}
+            manager = driver.PicarusManager(db=self)
+            chain_inputs, model_chain = zip(*(tables._takeout_input_model_chain_from_input(manager, inputs[input_type]) + [(inputs[input_type], model_link)]))
+            model_row = manager.input_model_param_to_key(**{'input': inputs[input_type], 'model_link': model_link, 'model_chain': list(model_chain), 'input_type': input_type,
+                                                            'output_type': output_type, 'email': email, 'name': manager.model_to_name(model_link),
+                                                            'factory_info': json.dumps(factory_info), 'model_chain_inputs': list(chain_inputs)})
+            progress.finish({'modelRow': model_row})
 
 
 class RedisDB(BaseDB):
@@ -317,92 +521,122 @@ class RedisDB(BaseDB):
             self.args = [server, port, db]
         self.__redis = redis.StrictRedis(host=server, port=port, db=db)
         # redis[table:row] -> data[table][row]
+        # redis[_index:table] -> sorted set of rows in table (all scores are 0 so they are ordered lexically)
+        self._index_prefix = '_index:'
+        self.index_per_call = 1000
+        self._get_rows_script = self.__redis.register_script(REDIS_GET_ROWS_LUA)
         super(RedisDB, self).__init__(*args, **kw)
 
     def __reduce__(self):
         return (RedisDB, tuple(self.args))
 
-    def _get_columns(self, table, row, columns, keys_only=False):
-        table_row = table + ':' + row
-        keys = self.__redis.hkeys(table_row)
-        cfs = set()
-        cols = set()
-        for c in columns:
-            cur_cf, cur_col = c.split(':', 1)
-            if cur_col:
-                cols.add(c)
-            else:
-                cfs.add(cur_cf)
-        out = {}
-        for k in keys:
-            if k in cols or k.split(':', 1)[0] in cfs:
-                if keys_only:
-                    out[k] = ''
-                else:
-                    d = self.__redis.hget(table_row, k)
-                    if d is not None:
-                        out[k] = d
-        return out
+    def close(self):
+        self.__redis.connection_pool.disconnect()
+
+    def _get_rows(self, table, rows, columns=None, keys_only=False, column_filter=None):
+        # Fetches a batch of rows in one round trip, projection and filtering happen inside redis
+        if not rows:
+            return []
+        if column_filter is None:
+            column_filter = ('', '', '')
+        args = ['1' if keys_only else '0'] + list(column_filter) + list(columns or [])
+        results = self._get_rows_script(keys=[table + ':' + row for row in rows], args=args)
+        return [dict(zip(x[::2], x[1::2])) for x in results]
+
+    def _pipe_mutate_row(self, pipe, table, row, mutations):
+        pipe.hmset(table + ':' + row, mutations)
+        pipe.zadd(self._index_prefix + table, 0, row)
+
+    def _pipe_delete_row(self, pipe, table, row):
+        pipe.delete(table + ':' + row)
+        pipe.zrem(self._index_prefix + table, row)
 
     def mutate_row(self, table, row, mutations):
-        self.__redis.hmset(table + ':' + row, mutations)
+        pipe = self.__redis.pipeline(transaction=False)
+        self._pipe_mutate_row(pipe, table, row, mutations)
+        pipe.execute()
 
     def delete_row(self, table, row):
-        self.__redis.delete(table + ':' + row)
+        pipe = self.__redis.pipeline(transaction=False)
+        self._pipe_delete_row(pipe, table, row)
+        pipe.execute()
+
+    def _flush_mutations(self, mutations):
+        pipe = self.__redis.pipeline(transaction=False)
+        for table, row, cur_mutations in mutations:
+            if cur_mutations is None:
+                self._pipe_delete_row(pipe, table, row)
+            else:
+                self._pipe_mutate_row(pipe, table, row, cur_mutations)
+        pipe.execute()
 
     def delete_column(self, table, row, column):
         self.__redis.hdel(table + ':' + row, column)
+        # NOTE: Redis removes empty hashes, so the row is gone once its last column is
+        if not self.__redis.exists(table + ':' + row):
+            self.__redis.zrem(self._index_prefix + table, row)
+
+    def build_row_index(self, table):
+        # Only needed for data written before the row index existed, uses SCAN so redis isn't blocked
+        index = self._index_prefix + table
+        pipe = self.__redis.pipeline(transaction=False)
+        for num, table_row in enumerate(self.__redis.scan_iter(match=table + ':*', count=self.index_per_call), 1):
+            pipe.zadd(index, 0, table_row.split(':', 1)[1])
+            if num % self.index_per_call == 0:
+                pipe.execute()
+        pipe.execute()
 
     def get_row(self, table, row, columns=None, check=True, keys_only=False):
-        if columns:
-            result = self._get_columns(table, row, columns, keys_only=keys_only)
-        else:
-            if keys_only:
-                result = dict((x, '') for x in self.__redis.hkeys(table + ':' + row))
-            else:
-                result = self.__redis.hgetall(table + ':' + row)
+        result = self._get_rows(table, [row], columns, keys_only=keys_only)[0]
         if check and not result:
             bottle.abort(404)
         return result
 
+    def get_rows(self, table, rows, columns=None):
+        return self._get_rows(table, rows, columns)
+
     def get_column(self, table, row, column):
         out = self.__redis.hget(table + ':' + row, column)
         if out is None:
             bottle.abort(404)
         return out
 
+    def _scan_rows(self, table, start_row=None, stop_row=None):
+        # Pages through the row index in [start_row, stop_row), cost depends on the slice not the table
+        index = self._index_prefix + table
+        min_row = '-' if start_row is None else '[' + start_row
+        max_row = '+' if stop_row is None else '(' + stop_row
+        while True:
+            rows = self.__redis.zrangebylex(index, min_row, max_row, start=0, num=self.index_per_call)
+            for row in rows:
+                yield row
+            if len(rows) < self.index_per_call:
+                break
+            min_row = '(' + rows[-1]
+
     def scanner(self, table, start_row=None, stop_row=None, columns=None, keys_only=False, per_call=1, column_filter=None):
-        keep_row = lambda x: True
         if column_filter:
-            filter_column = column_filter[0]
-            if column_filter[1] == '=':
-                keep_row = lambda x: filter_column in x and x[filter_column] == column_filter[2]
-            elif column_filter[1] == '!=':
-                keep_row = lambda x: filter_column in x and x[filter_column] != column_filter[2]
-            elif column_filter[1] == 'startswith':
-                keep_row = lambda x: filter_column in x and x[filter_column].startswith(column_filter[2])
-            else:
+            if column_filter[1] not in ('=', '!=', 'startswith'):
                 bottle.abort(400)  # Bad filter
-        if start_row is not None and stop_row is not None:
-            prefix = []
-            for x, y in zip(start_row, stop_row):
-                if x == y:
-                    prefix.append(x)
-                else:
-                    break
-            prefix = ''.join(prefix)
-        else:
-            prefix = ''
-        table_start_row = table + ':' if start_row is None else '%s:%s' % (table, start_row)
-        table_stop_row = None if stop_row is None else '%s:%s' % (table, stop_row)
-        for row in self.__redis.keys('%s:%s*' % (table, prefix)):
-            if row < table_start_row or (table_stop_row is not None and row >= table_stop_row):
-                continue
-            clean_row = row.split(':')[1]
-            cur_row = self.get_row(table, clean_row, check=False, keys_only=keys_only)
-            if not keep_row(cur_row):
-                continue
-            yield clean_row, cur_row
+            column_filter = tuple(column_filter[:3])
+        per_call = max(1, per_call)
+
+        def fetch(rows):
+            cur_rows = self._get_rows(table, rows, columns=columns, keys_only=keys_only, column_filter=column_filter)
+            for row, cur_row in zip(rows, cur_rows):
+                # NOTE: Empty when filtered out, without the selected columns, or removed after being read from the index
+                if not cur_row:
+                    continue
+                yield row, cur_row
+        rows = []
+        for row in self._scan_rows(table, start_row, stop_row):
+            rows.append(row)
+            if len(rows) >= per_call:
+                for x in fetch(rows):
+                    yield x
+                rows = []
+        for x in fetch(rows):
+            yield x
 
 
 class HBaseDB(BaseDB):
@@ -414,11 +648,16 @@ class HBaseDB(BaseDB):
             self.args = [server, port]
         self._thrift = hadoopy_hbase.connect(server, port, timeout=300000)
         self.num_mappers = 6
+        self._families = {}  # [table] = ['cf:', ...], used to batch row deletes
         super(HBaseDB, self).__init__(*args, **kw)
 
     def __reduce__(self):
         return HBaseDB, tuple(self.args)
 
+    def close(self):
+        # NOTE: hadoopy_hbase.connect returns the generated Hbase.Client, its protocol holds the transport
+        self._thrift._iprot.trans.close()
+
     def mutate_row(self, table, row, mutations):
         mutations = [hadoopy_hbase.Mutation(column=x, value=y) for x, y in mutations.items()]
         self._thrift.mutateRow(table, row, mutations)
@@ -426,6 +665,33 @@ class HBaseDB(BaseDB):
     def delete_row(self, table, row):
         self._thrift.deleteAllRow(table, row)
 
+    def _delete_row_mutations(self, table):
+        # Deleting every column family deletes the row, so deletes can be batched with mutateRows
+        try:
+            families = self._families[table]
+        except KeyError:
+            families = self._families[table] = [x if x.endswith(':') else x + ':'
+                                                for x in self._thrift.getColumnDescriptors(table)]
+        return [hadoopy_hbase.Mutation(column=x, isDelete=True) for x in families]
+
+    def _flush_mutations(self, mutations):
+        # Consecutive mutations (or deletes) to the same table go in one mutateRows call, order is preserved
+        # NOTE: A batch is only puts or only deletes as HBase applies a batch's puts before its deletes
+        batch_key, batch = None, []
+        for table, row, cur_mutations in mutations + [(None, None, None)]:
+            key = (table, cur_mutations is None)
+            if batch and key != batch_key:
+                self._thrift.mutateRows(batch_key[0], batch)
+                batch = []
+            if table is None:
+                break
+            batch_key = key
+            if cur_mutations is None:
+                batch.append(hadoopy_hbase.BatchMutation(row=row, mutations=self._delete_row_mutations(table)))
+            else:
+                batch.append(hadoopy_hbase.BatchMutation(row=row, mutations=[hadoopy_hbase.Mutation(column=x, value=y)
+                                                                             for x, y in cur_mutations.items()]))
+
     def delete_column(self, table, row, column):
         self._thrift.mutateRow(table, row, [hadoopy_hbase.Mutation(column=column, isDelete=True)])
 
@@ -438,6 +704,17 @@ class HBaseDB(BaseDB):
             bottle.abort(404)
         return dict((x, y.value) for x, y in result[0].columns.items())
 
+    def get_rows(self, table, rows, columns=None):
+        if not rows:
+            return []
+        if columns:
+            results = self._thrift.getRowsWithColumns(table, rows, columns)
+        else:
+            results = self._thrift.getRows(table, rows)
+        # NOTE: Missing rows are left out of the results
+        results = dict((x.row, dict((y, z.value) for y, z in x.columns.items())) for x in results)
+        return [results.get(row, {}) for row in rows]
+
     def get_column(self, table, row, column):
         try:
             return self._thrift.get(table, row, column)[0].value
@@ -3,10 +3,35 @@ import time
 import os
 import hashlib
 import msgpack
+import struct
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+def _msgpack_pieces(packer, x, max_piece_size):
+    # Same bytes as msgpack.dumps(x) but yielded in pieces so that it is never entirely in memory
+    if isinstance(x, dict):
+        yield packer.pack_map_header(len(x))
+        for k, v in x.items():
+            for y in _msgpack_pieces(packer, k, max_piece_size):
+                yield y
+            for y in _msgpack_pieces(packer, v, max_piece_size):
+                yield y
+    elif isinstance(x, (list, tuple)):
+        yield packer.pack_array_header(len(x))
+        for v in x:
+            for y in _msgpack_pieces(packer, v, max_piece_size):
+                yield y
+    elif isinstance(x, str) and len(x) > max(max_piece_size, 0xffff):
+        # NOTE: Large leaves (e.g., index data) are not copied, the Packer (use_bin_type=False) packs
+        # a str this size as raw 32 so we write its header and then slices of the str itself
+        yield '\xdb' + struct.pack('>I', len(x))
+        for offset in xrange(0, len(x), max_piece_size):
+            yield buffer(x, offset, max_piece_size)
+    else:
+        yield packer.pack(x)
+
+
 class PicarusManager(object):
 
     def __init__(self, db):
@@ -16,6 +41,7 @@ class PicarusManager(object):
         self.models_table = 'models'
         self.db = db
         self.max_cell_size = 1024 * 1024  # 1MB
+        self.chunks_per_call = 16  # Model chunks read in each get_row
         # Feature Hasher settings
         # Feature Classifier settings
         self.feature_classifier_row = self.images_table
@@ -30,6 +56,7 @@ class PicarusManager(object):
         self.model_link_column = 'data:model_link'
         self.model_chain_column = 'data:model_chain'
         self.input_column = 'meta:input'
+        self.model_chain_inputs_column = 'meta:model_chain_inputs'
         self.model_link_sha1_column = 'meta:model_link_sha1'
         self.model_chain_sha1_column = 'meta:model_chain_sha1'
         self.model_link_size_column = 'meta:model_link_size'
@@ -50,7 +77,8 @@ class PicarusManager(object):
                 'processed_image': 'data:', 'binary_class_confidence': 'pred:', 'mask_feature' : 'feat:', 'distance_image_rows': 'pred:',
                 'multi_class_distance': 'pred:', 'hash': 'hash:', 'multi_feature': 'feat:'}[output_type]
 
-    def input_model_param_to_key(self, input, model_link, model_chain, input_type, output_type, email, name, notes='', tags='', factory_info=None):
+    def input_model_param_to_key(self, input, model_link, model_chain, input_type, output_type, email, name, notes='', tags='', factory_info=None,
+                                 model_chain_inputs=None):
         assert isinstance(input, str)
         check_model = lambda x: isinstance(x, dict) and set(['name', 'kw']) == set(x.keys())
         dumps = lambda x: msgpack.dumps(x)
@@ -58,21 +86,37 @@ class PicarusManager(object):
         model_key = prefix + os.urandom(16)
         cols = {}
 
-        def save_model(model_str, model_column, model_chunks_column, model_sha1_column, model_size_column):
-            cols[model_sha1_column] = hashlib.sha1(model_str).hexdigest()
-            cols[model_size_column] = str(len(model_str))
+        def save_model(model, model_column, model_chunks_column, model_sha1_column, model_size_column):
+            # Encodes the model incrementally and writes each chunk as soon as it is full
+            sha1 = hashlib.sha1()
+            model_size = 0
             chunk_count = 0
-            while model_str:
-                self.db.mutate_row(self.models_table, model_key, {model_column + '-%d' % chunk_count: model_str[:self.max_cell_size]})
-                model_str = model_str[self.max_cell_size:]
+            # NOTE: Holds at most one chunk, pieces are copied in and it is written out whenever it fills
+            chunk = bytearray()
+            for piece in _msgpack_pieces(msgpack.Packer(), model, self.max_cell_size):
+                sha1.update(piece)
+                model_size += len(piece)
+                offset = 0
+                while offset < len(piece):
+                    num_bytes = min(self.max_cell_size - len(chunk), len(piece) - offset)
+                    chunk += piece[offset:offset + num_bytes]
+                    offset += num_bytes
+                    if len(chunk) == self.max_cell_size:
+                        self.db.mutate_row(self.models_table, model_key, {model_column + '-%d' % chunk_count: str(chunk)})
+                        chunk_count += 1
+                        chunk = bytearray()
+            if chunk:
+                self.db.mutate_row(self.models_table, model_key, {model_column + '-%d' % chunk_count: str(chunk)})
                 chunk_count += 1
+            cols[model_sha1_column] = sha1.hexdigest()
+            cols[model_size_column] = str(model_size)
             cols[model_chunks_column] = str(chunk_count)
         try:
             # Save the models ASAP chunk by chunk to reduce memory usage
             if check_model(model_link) and all(map(check_model, model_chain)):
                 model_chain_type = model_link_type = 'msgpack'
-                save_model(dumps(model_link), self.model_link_column, self.model_link_chunks_column, self.model_link_sha1_column, self.model_link_size_column)
-                save_model(dumps(model_chain), self.model_chain_column, self.model_chain_chunks_column, self.model_chain_sha1_column, self.model_chain_size_column)
+                save_model(model_link, self.model_link_column, self.model_link_chunks_column, self.model_link_sha1_column, self.model_link_size_column)
+                save_model(model_chain, self.model_chain_column, self.model_chain_chunks_column, self.model_chain_sha1_column, self.model_chain_size_column)
             else:
                 raise ValueError('Model must be a dict!')
             cols.update({self.input_column: input,
@@ -87,6 +131,10 @@ class PicarusManager(object):
                          'user:' + email: 'rw'})
             if factory_info is not None:
                 cols[self.factory_info_column] = factory_info
+            if model_chain_inputs is not None:
+                # Input column of each link in model_chain, lets the chain be loaded without walking the models
+                assert len(model_chain_inputs) == len(model_chain)
+                cols[self.model_chain_inputs_column] = dumps(model_chain_inputs)
             self.db.mutate_row(self.models_table, model_key, cols)
             return model_key
         except:
@@ -94,27 +142,38 @@ class PicarusManager(object):
             self.db.delete_row(self.models_table, model_key)
             raise
 
-    def key_to_model(self, key, model_type=None):
-        columns = dict((x[5:], y) for x, y in self.db.get_row(self.models_table, key, ['meta:']).items())
+    def key_to_model(self, key, model_type=None, columns=None):
+        # NOTE: columns may be given if the meta columns were already read
+        if columns is None:
+            columns = dict((x[5:], y) for x, y in self.db.get_row(self.models_table, key, ['meta:']).items())
         if model_type is None:
             return columns
         if model_type == 'link':
             model_chunks_column = self.model_link_chunks_column[5:]
+            model_size_column = self.model_link_size_column[5:]
             model_column = self.model_link_column
         elif model_type == 'chain':
             model_chunks_column = self.model_chain_chunks_column[5:]
+            model_size_column = self.model_chain_size_column[5:]
             model_column = self.model_chain_column
         else:
             raise ValueError
         model_chunks = int(columns[model_chunks_column])
-        # Get the chunks one at a time to relieve memory pressure
-        chunks = []
-        for x in range(model_chunks):
-            model_column_cur = model_column + '-%d' % x
-            model_val = self.db.get_row(self.models_table, key, [model_column_cur])[model_column_cur]
-            chunks.append((x, model_val))
-        chunks.sort()
-        return ''.join([x[1] for x in chunks]), columns
+        model_size = int(columns[model_size_column])
+        # Chunks are read several at a time directly into one buffer to relieve memory pressure
+        model = bytearray(model_size)
+        offset = 0
+        for x in range(0, model_chunks, self.chunks_per_call):
+            model_columns = [model_column + '-%d' % y for y in range(x, min(x + self.chunks_per_call, model_chunks))]
+            model_vals = self.db.get_row(self.models_table, key, model_columns)
+            for model_column_cur in model_columns:
+                model_val = model_vals[model_column_cur]
+                model[offset:offset + len(model_val)] = model_val
+                offset += len(model_val)
+            del model_vals
+        if offset != model_size:
+            raise ValueError('Model size mismatch')
+        return model, columns
 
     def model_to_name(self, model):
         args = list(model.get('args', []))
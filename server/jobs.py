@@ -11,6 +11,7 @@ import base64
 import uuid
 import pickle
 import time
+import collections
 import databases
 from hadoop_parse import scrape_hadoop_jobs
 
@@ -23,6 +24,65 @@ class NotFoundException(Exception):
     """Task was not found"""
 
 
+class TaskProgress(object):
+    """Accumulates a task's row counts in memory and writes them out periodically
+
+    Counts are sent with HINCRBY every interval seconds or max_rows rows,
+    whichever comes first, and always on finish/exit.
+    """
+
+    def __init__(self, jobs, task, interval, max_rows):
+        self._jobs = jobs
+        self.task = task
+        self.interval = interval
+        self.max_rows = max_rows
+        self.good_rows = 0
+        self.bad_rows = 0
+        self._pending_good_rows = 0
+        self._pending_bad_rows = 0
+        self._columns = {'status': 'running'}
+        self._last_flush = time.time()
+
+    def __enter__(self):
+        self.flush()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self._columns['status'] = 'failed'
+        self.flush()
+
+    def good(self, count=1):
+        self.good_rows += count
+        self._pending_good_rows += count
+        self._check_flush()
+
+    def bad(self, count=1):
+        self.bad_rows += count
+        self._pending_bad_rows += count
+        self._check_flush()
+
+    def update(self, columns):
+        self._columns.update(columns)
+        self._check_flush()
+
+    def _check_flush(self):
+        if self._pending_good_rows + self._pending_bad_rows >= self.max_rows or time.time() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self._jobs.increment_task(self.task, self._columns, goodRows=self._pending_good_rows, badRows=self._pending_bad_rows)
+        self._pending_good_rows = self._pending_bad_rows = 0
+        self._columns = {}
+        self._last_flush = time.time()
+
+    def finish(self, columns=None):
+        self._columns['status'] = 'completed'
+        if columns:
+            self._columns.update(columns)
+        self.flush()
+
+
 class Jobs(object):
 
     def __init__(self, host, port, db, annotation_redis_host, annotation_redis_port):
@@ -31,11 +91,17 @@ class Jobs(object):
         self.redis_port = port
         self.db = redis.StrictRedis(host=host, port=port, db=db)
         self._owner_prefix = 'owner:'
+        self._owner_index_prefix = 'ownertime:'
         self._task_prefix = 'task:'
         self._lock_prefix = 'lock:'
         self.annotation_redis_host = annotation_redis_host
         self.annotation_redis_port = annotation_redis_port
         self.hadoop_completed_jobs_cache = set()
+        # Task progress is written at most this often (sec) or every this many rows
+        self.progress_interval = 5.
+        self.progress_rows = 1000
+        # Tasks fetched per pipelined call when listing
+        self.tasks_per_call = 100
 
     def __reduce__(self):
         return (Jobs, self.args)
@@ -47,8 +113,11 @@ class Jobs(object):
         if not self.db.set(self._lock_prefix + task, '', nx=True):
             raise UnauthorizedException
         # TODO: Do these atomically
-        self.db.hmset(self._task_prefix + task, data)
-        self.db.sadd(self._owner_prefix + owner, task)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hmset(self._task_prefix + task, data)
+        pipe.sadd(self._owner_prefix + owner, task)
+        pipe.zadd(self._owner_index_prefix + owner, float(data['startTime']), task)
+        pipe.execute()
         return task
 
     def _check_owner(self, task, owner):
@@ -89,8 +158,11 @@ class Jobs(object):
         if task_type == 'annotation':
             manager = self.get_annotation_manager(task, data_connection=kw['data_connection'])
         # TODO: Do these atomically
-        self.db.delete(self._task_prefix + task, self._lock_prefix + task)
-        self.db.srem(self._owner_prefix + owner, task)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.delete(self._task_prefix + task, self._lock_prefix + task)
+        pipe.srem(self._owner_prefix + owner, task)
+        pipe.zrem(self._owner_index_prefix + owner, task)
+        pipe.execute()
         if task_type == 'annotation':
             manager.destroy()  # TODO: MTurk specific
         # TODO: For Hadoop jobs kill the task if it is running
@@ -99,6 +171,18 @@ class Jobs(object):
     def update_task(self, row, columns):
         self.db.hmset(self._task_prefix + row, columns)
 
+    def increment_task(self, row, columns, **counters):
+        pipe = self.db.pipeline(transaction=False)
+        for column, count in counters.items():
+            pipe.hincrby(self._task_prefix + row, column, count)
+        if columns:
+            pipe.hmset(self._task_prefix + row, columns)
+        pipe.execute()
+
+    def progress(self, row, interval=None, max_rows=None):
+        return TaskProgress(self, row, self.progress_interval if interval is None else interval,
+                            self.progress_rows if max_rows is None else max_rows)
+
     def update_hadoop_jobs(self, hadoop_jobtracker):
         for row, columns in scrape_hadoop_jobs(hadoop_jobtracker, self.hadoop_completed_jobs_cache).items():
             # NOTE: We do this at this point as a job may not exist but is finished completed/failed in hadoop
@@ -112,15 +196,52 @@ class Jobs(object):
             # TODO: Need to do this atomically with the exists check
             self.update_task(row, columns)
 
-    def get_tasks(self, owner):
-        outs = {}
-        for job_key in self.db.smembers(self._owner_prefix + owner):
-            # TODO: Error check if something gets removed while we are accumulating
-            task = self._task_prefix + job_key
-            if self.db.hget(task, 'owner') == owner:
-                out = self.db.hgetall(task)
-                out = dict((k, v) for k, v in out.items() if not k.startswith('_'))
-                outs[task.split(':', 1)[1]] = out
+    def build_owner_index(self, owner):
+        # Sorted set of the owner's tasks scored by startTime, add_task/delete_task keep it up to date
+        job_keys = list(self.db.smembers(self._owner_prefix + owner))
+        pipe = self.db.pipeline(transaction=False)
+        for job_key in job_keys:
+            pipe.hget(self._task_prefix + job_key, 'startTime')
+        start_times = pipe.execute()
+        pipe = self.db.pipeline(transaction=False)
+        for job_key, start_time in zip(job_keys, start_times):
+            pipe.zadd(self._owner_index_prefix + owner, float(start_time or 0), job_key)
+        pipe.execute()
+
+    def build_owner_indexes(self):
+        # NOTE: Only needed once for tasks added before the index existed (see setup_redis.py)
+        for owner_key in self.db.keys(self._owner_prefix + '*'):
+            self.build_owner_index(owner_key[len(self._owner_prefix):])
+
+    def get_tasks(self, owner, offset=0, count=None, status=None):
+        """Owner's tasks, newest first
+
+        offset/count apply after filtering by status, without a status only
+        offset + count tasks are read.
+        """
+        index = self._owner_index_prefix + owner
+        outs = collections.OrderedDict()
+        skip = offset if status else 0
+        pos = 0 if status else offset
+        while count is None or len(outs) < count:
+            num = self.tasks_per_call if count is None or status else count - len(outs)
+            job_keys = self.db.zrevrange(index, pos, pos + num - 1)
+            if not job_keys:
+                break
+            pos += len(job_keys)
+            pipe = self.db.pipeline(transaction=False)
+            for job_key in job_keys:
+                pipe.hgetall(self._task_prefix + job_key)
+            for job_key, out in zip(job_keys, pipe.execute()):
+                # NOTE: Tasks deleted while we are accumulating come back empty and are skipped
+                if out.get('owner') != owner or (status and out.get('status') != status):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                outs[job_key] = dict((k, v) for k, v in out.items() if not k.startswith('_'))
+                if count is not None and len(outs) >= count:
+                    break
         return outs
 
     def get_annotation_manager(self, task, data_connection, sync=False):
@@ -175,6 +296,9 @@ def main():
     def _destroy(args, jobs):
         jobs.db.flushall()
 
+    def _index(args, jobs):
+        jobs.build_owner_indexes()
+
     def job_worker(db, func, method_args, method_kwargs):
         getattr(db, func)(*method_args, **method_kwargs)
 
@@ -213,6 +337,7 @@ def main():
     parser.add_argument('--thrift_server', default='localhost')
     parser.add_argument('--thrift_port', default='9090')
     parser.add_argument('--database', choices=['hbase', 'hbasehadoop', 'redis'], default='hbasehadoop', help='Select which database to use as our backend.  Those ending in hadoop use it for job processing.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of processes used for row jobs that are not run on Hadoop.')
     subparsers = parser.add_subparsers(help='Commands')
 
     subparser = subparsers.add_parser('info', help='Display info about jobs')
@@ -221,6 +346,9 @@ def main():
     subparser = subparsers.add_parser('destroy', help='Delete everything in the jobs DB')
     subparser.set_defaults(func=_destroy)
 
+    subparser = subparsers.add_parser('index', help='Index existing jobs by owner and startTime (also done by setup_redis.py)')
+    subparser.set_defaults(func=_index)
+
     subparser = subparsers.add_parser('work', help='Do background work')
     parser.add_argument('queues', nargs='+', help='Queues to do work on')
     subparser.set_defaults(func=_work)
@@ -230,7 +358,7 @@ def main():
                 args.annotations_redis_host, args.annotations_redis_port)
 
     def THRIFT_CONSTRUCTOR():
-        return databases.factory(args.database, True, jobs,
+        return databases.factory(args.database, True, jobs, num_workers=args.num_workers,
                                  thrift_server=args.thrift_server, thrift_port=args.thrift_port,
                                  redis_host=args.redis_host, redis_port=args.redis_port)
     args.func(args, jobs)
@@ -5,6 +5,7 @@ import bottle
 bottle.BaseRequest.MEMFILE_MAX = 50 * 1024 ** 2  # 50MB file cap
 import argparse
 import gevent.queue
+import gevent.lock
 import base64
 import gevent
 import mturk_vision
@@ -15,6 +16,7 @@ import jobs
 import logging
 import contextlib
 import tables
+import worker_pool
 
 MAX_CONNECTIONS = 10000  # gevent pool size
 
@@ -51,7 +53,13 @@ def thrift_lock():
 
 @contextlib.contextmanager
 def thrift_new():
-    yield THRIFT_CONSTRUCTOR()
+    # Dedicated connection (e.g., for a long streamed response), at most --stream_connections are open at once
+    with THRIFT_NEW_SEMAPHORE:
+        cur_thrift = THRIFT_CONSTRUCTOR()
+        try:
+            yield cur_thrift
+        finally:
+            cur_thrift.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.WARN)
@@ -69,13 +77,21 @@ if __name__ == "__main__":
     parser.add_argument('--thrift_server', default='localhost')
     parser.add_argument('--thrift_port', default='9090')
     parser.add_argument('--database', choices=['hbase', 'hbasehadoop', 'redis'], default='hbasehadoop', help='Select which database to use as our backend.  Those ending in hadoop use it for job processing.')
+    parser.add_argument('--model_cache_size', type=int, default=512, help='Size (MB) of the in-memory cache of models used for row predictions.')
+    parser.add_argument('--model_workers', type=int, default=0, help='Number of processes that run synchronous model predictions (e.g., i/chain, i/thumbnail).  If 0 they run in the server process.')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of processes used for row jobs that are not run on Hadoop (with --local).')
+    parser.add_argument('--import_root', help='If set, archives in this directory can be imported into the images table by path.')
+    parser.add_argument('--usage_interval', type=float, default=1., help='API usage is written in batches every this many seconds.')
+    parser.add_argument('--stream_connections', type=int, default=16, help='Max number of dedicated database connections for streamed slices/exports, more wait for one to close.')
+    parser.add_argument('--auth_cache_ttl', type=float, default=10., help='Verified API keys and user prefixes are cached in memory for this many seconds (0 to disable).')
     ARGS = parser.parse_args()
     if ARGS.raven:
         import raven
         RAVEN = raven.Client(ARGS.raven)
     THRIFT_POOL = gevent.queue.Queue()
+    THRIFT_NEW_SEMAPHORE = gevent.lock.BoundedSemaphore(ARGS.stream_connections)
 
-    USERS = Users(ARGS.redis_host, ARGS.redis_port, 0)
+    USERS = Users(ARGS.redis_host, ARGS.redis_port, 0, usage_interval=ARGS.usage_interval, cache_ttl=ARGS.auth_cache_ttl)
     YUBIKEY = Yubikey(ARGS.redis_host, ARGS.redis_port, 1)
     JOBS = jobs.Jobs(ARGS.redis_host, ARGS.redis_port, 3, ARGS.annotations_redis_host, ARGS.annotations_redis_port)
     # Set necessary globals in tables module
@@ -83,6 +99,11 @@ if __name__ == "__main__":
     tables.thrift_lock = thrift_lock
     tables.thrift_new = thrift_new
     tables.JOBS = JOBS
+    tables.MODEL_CACHE = tables.ModelCache(ARGS.model_cache_size * 1024 ** 2)
+    tables.IMPORT_ROOT = ARGS.import_root
+    if ARGS.model_workers > 0:
+        # NOTE: Started before the server/database connections exist so the forked workers don't inherit them
+        tables.MODEL_POOL = worker_pool.WorkerPool(ARGS.model_workers, tables.model_worker)
 
 
 def print_request():
@@ -200,6 +221,34 @@ def data_slice(_auth_user, table_name, start_row, stop_row):
         bottle.abort(403)
 
 
+@bottle.route('/<version:re:[^/]*>/rows/<table_name:re:[^/]+>', 'PATCH')
+@bottle.get('/<version:re:[^/]*>/rows/<table_name:re:[^/]+>')
+@bottle.post('/<version:re:[^/]*>/rows/<table_name:re:[^/]+>')
+@USERS.auth_api_key(True)
+@check_version
+def data_rows(_auth_user, table_name):
+    table = tables.get_table(_auth_user, table_name)
+    method = bottle.request.method.upper()
+    if method == 'PATCH':
+        if tables.MSGPACK_CONTENT_TYPE not in bottle.request.content_type:
+            bottle.abort(400, 'Content-Type must be %s' % tables.MSGPACK_CONTENT_TYPE)
+        try:
+            patch_rows = table.patch_rows
+        except AttributeError:
+            bottle.abort(403)
+        return patch_rows(bottle.request.body)
+    params, files = parse_params_files()
+    try:
+        get_rows = table.get_rows
+    except AttributeError:
+        bottle.abort(403)
+    try:
+        rows = [base64.b64decode(x) for x in params.pop('rows').split(',') if x]
+    except KeyError:
+        bottle.abort(400, 'Missing parameter [rows]')
+    return get_rows(rows, parse_columns(), params, files)
+
+
 @bottle.get('/static/<name:re:[^/]+>')
 def static(name):
     try:
@@ -360,6 +409,7 @@ if __name__ == '__main__':
         logging.warn('Free Count[%d] (will kill outstanding processes in 120 sec.)' % SERVER.pool.free_count())
         SERVER.pool.join(timeout=120)
         SERVER.close()
+        USERS.flush_usage()
         logging.warn('Shut down successful')
 
     def refresh_hadoop_jobs():
@@ -372,11 +422,15 @@ if __name__ == '__main__':
             gevent.sleep(5.)
     if ARGS.reloader:
         gevent.spawn(reloader)
+    if ARGS.usage_interval:
+        gevent.spawn(USERS.usage_flusher)
+    if ARGS.auth_cache_ttl:
+        gevent.spawn(USERS.cache_invalidator)
     if ARGS.hadoop_jobtracker and ARGS.database.endswith('hadoop'):
         gevent.spawn(refresh_hadoop_jobs)
 
     def THRIFT_CONSTRUCTOR():
-        return databases.factory(ARGS.database, ARGS.local, JOBS,
+        return databases.factory(ARGS.database, ARGS.local, JOBS, num_workers=ARGS.num_workers,
                                  thrift_server=ARGS.thrift_server, thrift_port=ARGS.thrift_port,
                                  redis_host=ARGS.redis_host, redis_port=ARGS.redis_port)
     for x in range(16):
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+import databases
+import jobs
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Picarus redis database setup (builds the row and job indexes for existing data)')
+    parser.add_argument('--redis_host', help='Redis Host', default='localhost')
+    parser.add_argument('--redis_port', type=int, help='Redis Port', default=6379)
+    parser.add_argument('--tables', nargs='+', default=['images', 'models'])
+    ARGS = parser.parse_args()
+    db = databases.RedisDB(ARGS.redis_host, ARGS.redis_port, 2, None, True)
+    for table in ARGS.tables:
+        print('Indexing [%s]' % table)
+        db.build_row_index(table)
+    print('Indexing jobs by owner')
+    jobs.Jobs(ARGS.redis_host, ARGS.redis_port, 3, None, None).build_owner_indexes()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,14 @@ import uuid
 import re
 import picarus_takeout
 import functools
+import collections
 import msgpack
+import hashlib
+import os
+import struct
+import tarfile
+import tempfile
+import shutil
 from driver import PicarusManager
 from parameters import PARAM_SCHEMAS_SERVE
 from model_factories import FACTORIES
@@ -17,14 +24,20 @@ thrift_lock = None
 thrift_new = None
 VERSION = None
 JOBS = None
+MODEL_CACHE = None
+MODEL_POOL = None  # If set, a worker_pool.WorkerPool(n, model_worker) that runs the models
+MODEL_META_TTL = 60.
+_MODEL_META = {}  # [key] = (expiration, meta columns)
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+IMPORT_ROOT = None  # If set, archives under this directory can be imported by path
 
 
-def dod_to_lod_b64(dod):
+def dod_to_lod_b64(dod, ordered=False):
     # Converts from dod[row][column] to list of {row, col0_ub64:val0_b64, ...}
-    # dod: dict of dicts
+    # dod: dict of dicts (sorted by row unless ordered, e.g., an OrderedDict)
     # lod: list of dicts
     outs = []
-    for row, columns in sorted(dod.items(), key=lambda x: x[0]):
+    for row, columns in (dod.items() if ordered else sorted(dod.items(), key=lambda x: x[0])):
         out = {'row': base64.b64encode(row)}
         out.update(dict((base64.b64encode(x), base64.b64encode(y) if isinstance(y, str) else base64.b64encode(json.dumps(y))) for x, y in columns.items()))
         outs.append(out)
@@ -33,12 +46,55 @@ def dod_to_lod_b64(dod):
 PARAM_SCHEMAS_B64 = dod_to_lod_b64(PARAM_SCHEMAS_SERVE)
 
 
-def encode_row(row, columns):
+def encode_row(row, columns, raw=False):
+    if raw:
+        out = dict(columns)
+        out['row'] = row
+        return out
     out = dict((base64.b64encode(k), base64.b64encode(v)) for k, v in columns.items())
     out['row'] = base64.b64encode(row)
     return out
 
 
+def encode_columns(columns, raw=False):
+    if raw:
+        return columns
+    return dict((base64.b64encode(k), base64.b64encode(v)) for k, v in columns.items())
+
+
+def _tar_member(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    return info.tobuf(tarfile.GNU_FORMAT) + data + '\0' * (-len(data) % tarfile.BLOCKSIZE)
+
+
+def _length_prefixed(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def accepts_msgpack():
+    # Clients that send "Accept: application/x-msgpack" get binary rows/columns (no base64)
+    return MSGPACK_CONTENT_TYPE in bottle.request.headers.get('Accept', '')
+
+
+def dumps_response(data, raw=False):
+    if raw:
+        bottle.response.headers["Content-type"] = MSGPACK_CONTENT_TYPE
+        out = msgpack.packb(data)
+    else:
+        bottle.response.headers["Content-type"] = "application/json"
+        out = json.dumps(data)
+    if bottle.request.method == 'GET':
+        # NOTE: The ETag is a hash of the body, clients revalidate cached rows/slices with If-None-Match
+        etag = '"%s"' % hashlib.sha1(out).hexdigest()
+        bottle.response.headers['ETag'] = etag
+        if etag in bottle.request.headers.get('If-None-Match', ''):
+            bottle.response.status = 304
+            return ''
+    return out
+
+
 def key_to_model(manager, *args, **kw):
     try:
         return manager.key_to_model(*args, **kw)
@@ -46,26 +102,28 @@ def key_to_model(manager, *args, **kw):
         bottle.abort(404)
 
 
-def _takeout_model_link_from_key(manager, key):
-    print('Manager key[%r]' % key)
-    model_binary, columns = key_to_model(manager, key, 'link')
-    model = msgpack.loads(model_binary)
-    if not isinstance(model, dict):
-        bottle.abort(500)
-    return model
+def _model_meta(manager, key):
+    # Meta columns of a model, memoized for MODEL_META_TTL sec and invalidated on models table writes
+    now = time.time()
+    try:
+        expiration, columns = _MODEL_META[key]
+        if now < expiration:
+            return columns
+    except KeyError:
+        pass
+    columns = key_to_model(manager, key)
+    _MODEL_META[key] = now + MODEL_META_TTL, columns
+    return columns
 
 
-def _takeout_model_chain_from_key(manager, key):
-    if key == 'data:image':
-        return []
-    columns = key_to_model(manager, key)
-    if columns['input_type'] == 'raw_image':
-        return [_takeout_model_link_from_key(manager, key)]
-    return _takeout_model_chain_from_key(manager, columns['input']) + [_takeout_model_link_from_key(manager, key)]
+def _invalidate_model(key):
+    _MODEL_META.pop(key, None)
+    MODEL_CACHE.pop(('link', key))
+    MODEL_CACHE.pop(('chain', key))
 
 
 def _takeout_input_model_link_from_key(manager, key):
-    model_binary, columns = key_to_model(manager, key, 'link')
+    model_binary, columns = key_to_model(manager, key, 'link', columns=_model_meta(manager, key))
     model = msgpack.loads(model_binary)
     if not isinstance(model, dict):
         bottle.abort(500)
@@ -73,10 +131,126 @@ def _takeout_input_model_link_from_key(manager, key):
 
 
 def _takeout_input_model_chain_from_key(manager, key):
-    columns = key_to_model(manager, key)
-    if columns['input_type'] == 'raw_image':
-        return [_takeout_input_model_link_from_key(manager, key)]
-    return _takeout_input_model_chain_from_key(manager, columns['input']) + [_takeout_input_model_link_from_key(manager, key)]
+    # Returns [(input, model_link), ...], uses the chain and inputs stored with the model (one read)
+    columns = _model_meta(manager, key)
+    try:
+        chain_inputs = msgpack.loads(columns['model_chain_inputs'])
+    except KeyError:
+        # NOTE: Models created before chain inputs were stored need to walk the model graph
+        if columns['input_type'] == 'raw_image':
+            return [_takeout_input_model_link_from_key(manager, key)]
+        return _takeout_input_model_chain_from_key(manager, columns['input']) + [_takeout_input_model_link_from_key(manager, key)]
+    model_binary, columns = key_to_model(manager, key, 'chain', columns=columns)
+    model_chain = msgpack.loads(model_binary)
+    if not isinstance(model_chain, list) or len(model_chain) != len(chain_inputs):
+        bottle.abort(500)
+    return zip(chain_inputs, model_chain)
+
+
+def _takeout_input_model_chain_from_input(manager, input):
+    if input == 'data:image':
+        return []
+    return _takeout_input_model_chain_from_key(manager, input)
+
+
+class ModelCache(object):
+    """LRU cache of constructed models, bounded by the size of their serialized form
+
+    Entries are stored with the sha1 of the model they were built from and
+    are only returned if it matches the current one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._byte_count = 0
+        self._cache = collections.OrderedDict()  # [key] = (sha1, value, size)
+
+    def get(self, key, sha1):
+        try:
+            cur_sha1, value, size = self._cache.pop(key)
+        except KeyError:
+            return
+        if cur_sha1 != sha1:
+            self._byte_count -= size
+            return
+        self._cache[key] = cur_sha1, value, size
+        return value
+
+    def pop(self, key):
+        try:
+            self._byte_count -= self._cache.pop(key)[2]
+        except KeyError:
+            pass
+
+    def put(self, key, sha1, value, size):
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+        self._cache[key] = sha1, value, size
+        self._byte_count += size
+        while self._byte_count > self.max_bytes:
+            self._byte_count -= self._cache.popitem(last=False)[1][2]
+
+
+def model_worker(cache_key, sha1, model_str, binary_input):
+    # Runs in MODEL_POOL processes, each has its own MODEL_CACHE and model_str is only sent on a miss
+    model = MODEL_CACHE.get(cache_key, sha1)
+    if model is None:
+        if model_str is None:
+            return False, None
+        model = picarus_takeout.ModelChain(model_str)
+        MODEL_CACHE.put(cache_key, sha1, model, len(model_str))
+    return True, model.process_binary(binary_input)
+
+
+class PooledModel(object):
+    """Model that is run in the MODEL_POOL worker processes instead of the server's event loop"""
+
+    def __init__(self, cache_key, sha1, model_str):
+        self.cache_key = cache_key
+        self.sha1 = sha1
+        self.model_str = model_str
+
+    def process_binary(self, binary_input):
+        loaded, model_out = MODEL_POOL.apply(self.cache_key, self.sha1, None, binary_input)
+        if not loaded:
+            loaded, model_out = MODEL_POOL.apply(self.cache_key, self.sha1, self.model_str, binary_input)
+        return model_out
+
+
+def _load_model(cache_key, sha1, model_str):
+    if MODEL_POOL is None:
+        return picarus_takeout.ModelChain(model_str)
+    return PooledModel(cache_key, sha1, model_str)
+
+
+def _takeout_model_from_key(manager, key, model_type):
+    # Returns (chain_input, ModelChain), repeated calls with an unchanged model skip loading it
+    sha1 = _model_meta(manager, key)['model_%s_sha1' % model_type]
+    cache_key = (model_type, key)
+    out = MODEL_CACHE.get(cache_key, sha1)
+    if out is not None:
+        return out
+    if model_type == 'link':
+        chain_input, model_link = _takeout_input_model_link_from_key(manager, key)
+        model_chain = [model_link]
+    else:
+        chain_inputs, model_chain = zip(*_takeout_input_model_chain_from_key(manager, key))
+        chain_input = chain_inputs[0]
+    model_str = msgpack.dumps(list(model_chain))
+    out = chain_input, _load_model(cache_key, sha1, model_str)
+    MODEL_CACHE.put(cache_key, sha1, out, len(model_str))
+    return out
+
+
+def _thumbnail_model():
+    # Makes 150x150 thumbnails from the data:image column
+    model = MODEL_CACHE.get(('thumbnail',), '')
+    if model is None:
+        model_str = msgpack.dumps([{'name': 'picarus.ImagePreprocessor', 'kw': {'method': 'force_square', 'size': 150, 'compression': 'jpg'}}])
+        model = _load_model(('thumbnail',), '', model_str)
+        MODEL_CACHE.put(('thumbnail',), '', model, len(model_str))
+    return model
 
 
 def _parse_params(params, schema):
@@ -174,9 +348,10 @@ def _create_model_from_params(manager, email, path, params):
         model_params = _parse_params(params, schema)
         model_link = {'name': schema['name'], 'kw': model_params}
         input = _get_input(params, schema['input_type'])
-        model_chain = _takeout_model_chain_from_key(manager, input) + [model_link]
-        row = manager.input_model_param_to_key(input=input, model_link=model_link, model_chain=model_chain, input_type=schema['input_type'],
-                                               output_type=schema['output_type'], email=email, name=manager.model_to_name(model_link))
+        chain_inputs, model_chain = zip(*(_takeout_input_model_chain_from_input(manager, input) + [(input, model_link)]))
+        row = manager.input_model_param_to_key(input=input, model_link=model_link, model_chain=list(model_chain), input_type=schema['input_type'],
+                                               output_type=schema['output_type'], email=email, name=manager.model_to_name(model_link),
+                                               model_chain_inputs=list(chain_inputs))
         return {'row': base64.b64encode(row)}
     except ValueError:
         raise
@@ -198,9 +373,11 @@ class BaseTableSmall(object):
         super(BaseTableSmall, self).__init__()
 
     def get_table(self, columns):
+        return self._dumps_table(self._get_table(), columns)
+
+    def _dumps_table(self, full_table, columns):
         bottle.response.headers["Content-type"] = "application/json"
         columns = set(columns)
-        full_table = self._get_table()
         if columns:
             columns.add('row')
             return json.dumps([dict((y, x[y]) for y in columns.intersection(x)) for x in full_table])
@@ -241,10 +418,21 @@ class UsageTable(BaseTableSmall):
 
     def __init__(self, _auth_user):
         super(UsageTable, self).__init__()
-        self._table = dod_to_lod_b64(_auth_user.usage())
+        self._auth_user = _auth_user
 
-    def _get_table(self):
-        return self._table
+    def get_table(self, columns):
+        params = bottle.request.params
+        try:
+            start_time = float(params['startTime']) if 'startTime' in params else None
+            stop_time = float(params['stopTime']) if 'stopTime' in params else None
+            # NOTE: usage raises ValueError for non-finite times or startTime > stopTime
+            table = self._get_table(start_time, stop_time)
+        except ValueError:
+            bottle.abort(400, 'Invalid parameter value [startTime/stopTime]')
+        return self._dumps_table(table, columns)
+
+    def _get_table(self, start_time=None, stop_time=None):
+        return dod_to_lod_b64(self._auth_user.usage(start_time, stop_time))
 
 
 class RedisUsersTable(BaseTableSmall):
@@ -324,14 +512,25 @@ class JobsTable(BaseTableSmall):
         self.owner = _auth_user.email
         self._auth_user = _auth_user
 
-    def _get_table(self):
+    def get_table(self, columns):
+        params = bottle.request.params
         try:
-            cur_table = JOBS.get_tasks(self.owner)
+            offset = int(params.get('offset', 0))
+            count = int(params['maxRows']) if 'maxRows' in params else None
+        except ValueError:
+            bottle.abort(400, 'Invalid parameter value [offset/maxRows]')
+        if offset < 0 or (count is not None and count < 0):
+            bottle.abort(400, 'Invalid parameter value [offset/maxRows]')
+        return self._dumps_table(self._get_table(offset, count, params.get('status')), columns)
+
+    def _get_table(self, offset=0, count=None, status=None):
+        try:
+            cur_table = JOBS.get_tasks(self.owner, offset, count, status)
         except jobs.UnauthorizedException:
             bottle.abort(401)
         except jobs.NotFoundException:
             bottle.abort(404)
-        return dod_to_lod_b64(cur_table)
+        return dod_to_lod_b64(cur_table, ordered=True)
 
     def delete_row(self, row):
         try:
@@ -494,46 +693,64 @@ class HBaseTable(object):
         with thrift_lock() as thrift:
             self._row_validate(row, 'r', thrift)
             result = thrift.get_row(self.table, row, columns)
-        return dict((base64.b64encode(x), base64.b64encode(y))
-                    for x, y in result.items())
+        raw = accepts_msgpack()
+        return dumps_response(encode_columns(result, raw), raw)
 
 
 class DataHBaseTable(HBaseTable):
+    max_batch_rows = 1000
 
     def __init__(self, _auth_user, table):
         super(DataHBaseTable, self).__init__(_auth_user, table)
-        self.prefixes = _auth_user.prefixes(table)
+        self._auth_user = _auth_user
         self.upload_row_prefix = _auth_user.upload_row_prefix
+        self._prefix_indexes = {}  # [permissions] = PrefixIndex
+
+    def _prefix_index(self, permissions):
+        # NOTE: Kept for the life of the table (one request) so per sub-slice checks don't rebuild it when the user cache is off
+        try:
+            return self._prefix_indexes[permissions]
+        except KeyError:
+            out = self._prefix_indexes[permissions] = self._auth_user.prefix_index(self.table, permissions)
+            return out
 
     def _slice_validate(self, start_row, stop_row, permissions):
-        prefixes = self.prefixes
-        permissions = set(permissions)
-        prefixes = [x for x, y in prefixes.items() if set(y).issuperset(permissions)]
-        for prefix in prefixes:
-            if prefix == '':
-                return
-            # NOTE: Prevents rollover, minor limitation on prefix is that it must not end in \xff
-            assert prefix[-1] != '\xff'
-            prefix_start_row = prefix
-            prefix_stop_row = prefix[:-1] + chr(ord(prefix[-1]) + 1)
-            if start_row and prefix_start_row <= start_row < prefix_stop_row and stop_row and prefix_start_row <= stop_row <= prefix_stop_row:
-                return
-        bottle.abort(401)
+        if not self._prefix_index(permissions).contains_slice(start_row, stop_row):
+            bottle.abort(401)
 
     def _row_validate(self, row, permissions, thrift=None):
-        prefixes = self.prefixes
-        permissions = set(permissions)
-        prefixes = [x for x, y in prefixes.items() if set(y).issuperset(permissions)]
-        for prefix in prefixes:
-            if prefix == '':
-                return
-            # NOTE: Prevents rollover, minor limitation on prefix is that it must not end in \xff
-            assert prefix[-1] != '\xff'
-            prefix_start_row = prefix
-            prefix_stop_row = prefix[:-1] + chr(ord(prefix[-1]) + 1)
-            if row and prefix_start_row <= row < prefix_stop_row:
-                return
-        bottle.abort(401)
+        self._rows_validate([row], permissions)
+
+    def _rows_validate(self, rows, permissions):
+        prefix_index = self._prefix_index(permissions)
+        for row in rows:
+            if not prefix_index.contains_row(row):
+                bottle.abort(401)
+
+    def get_rows(self, rows, columns, params, files):
+        # Batch of (not necessarily contiguous) rows, missing rows are left out
+        if len(rows) > self.max_batch_rows:
+            bottle.abort(400, 'Too many rows (max %d)' % self.max_batch_rows)
+        self._rows_validate(rows, 'r')
+        try:
+            max_bytes = min(5242880, int(params.get('maxBytes', 5242880)))
+        except ValueError:
+            bottle.abort(400, 'Invalid parameter value [maxBytes]')
+        raw = accepts_msgpack()
+        out = []
+        byte_count = 0
+        # NOTE: Read in chunks (smaller for whole rows, e.g., images) so an oversized batch is stopped early
+        per_call = 100 if columns else 10
+        with thrift_lock() as thrift:
+            for num in range(0, len(rows), per_call):
+                cur_rows = rows[num:num + per_call]
+                for row, cur_columns in zip(cur_rows, thrift.get_rows(self.table, cur_rows, columns)):
+                    if cur_columns:
+                        byte_count += len(row) + sum(len(x) + len(y) for x, y in cur_columns.items())
+                        out.append(encode_row(row, cur_columns, raw))
+                if byte_count > max_bytes:
+                    bottle.abort(400, 'Rows too large (max %d bytes), request fewer rows or columns' % max_bytes)
+        return dumps_response(out, raw)
 
     def post_table(self, params, files):
         row = self.upload_row_prefix + '%.10d%s' % (2147483648 - int(time.time()), uuid.uuid4().bytes)
@@ -547,8 +764,84 @@ class DataHBaseTable(HBaseTable):
             byte_count += row_bytes + column_bytes * len(lod_row)
         return byte_count
 
+    def _get_slice_stream(self, start_row, stop_row, columns, max_rows, max_bytes, exclude_start, raw):
+        # Newline delimited JSON (or consecutive msgpack objects if raw), each row is sent as soon as it
+        # is read so memory doesn't grow with the slice
+        # NOTE: The response may take a long time to download, a dedicated connection keeps it from holding one in the pool
+        with thrift_new() as thrift:
+            scanner = thrift.scanner(self.table, per_call=10, columns=columns,
+                                     start_row=start_row, stop_row=stop_row)
+            num_rows = 0
+            byte_count = 0
+            for row_num, (cur_row, cur_columns) in enumerate(scanner, 1):
+                if exclude_start and row_num == 1:
+                    continue
+                if raw:
+                    out = msgpack.packb(encode_row(cur_row, cur_columns, raw))
+                else:
+                    out = json.dumps(encode_row(cur_row, cur_columns)) + '\n'
+                yield out
+                num_rows += 1
+                byte_count += len(out)
+                if (max_rows is not None and num_rows >= max_rows) or (max_bytes is not None and byte_count >= max_bytes):
+                    break
+
+    def _export_slice(self, start_row, stop_row, columns, export_format, max_rows, max_bytes, exclude_row):
+        # Rows are written as they are scanned.  If a limit ends the export before stop_row then the
+        # last record is the continuation token (ub64 of the last row) used to resume after it.
+        # NOTE: Uses a dedicated connection for the same reason as _get_slice_stream
+        with thrift_new() as thrift:
+            scanner = thrift.scanner(self.table, per_call=10, columns=columns,
+                                     start_row=start_row, stop_row=stop_row)
+            num_rows = 0
+            byte_count = 0
+            last_row = None
+            for cur_row, cur_columns in scanner:
+                if cur_row == exclude_row:
+                    continue
+                if (max_rows is not None and num_rows >= max_rows) or (max_bytes is not None and byte_count >= max_bytes):
+                    if export_format == 'tar':
+                        yield _tar_member('.continuation', base64.urlsafe_b64encode(last_row))
+                    else:
+                        yield _length_prefixed(msgpack.packb({'continuation': base64.urlsafe_b64encode(last_row)}))
+                    break
+                if export_format == 'tar':
+                    # NOTE: Same layout as utils/picarus_uploader.py (<ub64row>/<ub64col>)
+                    out = ''.join(_tar_member(base64.urlsafe_b64encode(cur_row) + '/' + base64.urlsafe_b64encode(x), y)
+                                  for x, y in cur_columns.items())
+                else:
+                    out = _length_prefixed(msgpack.packb([cur_row, cur_columns]))
+                yield out
+                last_row = cur_row
+                num_rows += 1
+                byte_count += len(out)
+            if export_format == 'tar':
+                yield '\0' * (2 * tarfile.BLOCKSIZE)
+
     def get_slice(self, start_row, stop_row, columns, params, files):
         self._slice_validate(start_row, stop_row, 'r')
+        if 'export' in params:
+            export_format = params['export']
+            if export_format not in ('tar', 'msgpack'):
+                bottle.abort(400, 'Invalid parameter value [export]')
+            exclude_row = None
+            if 'continuation' in params:
+                exclude_row = base64.urlsafe_b64decode(params['continuation'])
+                if not start_row <= exclude_row < stop_row:
+                    bottle.abort(400, 'Invalid parameter value [continuation]')
+                start_row = exclude_row
+            max_rows = int(params['maxRows']) if 'maxRows' in params else None
+            max_bytes = int(params['maxBytes']) if 'maxBytes' in params else None
+            bottle.response.headers["Content-type"] = 'application/x-tar' if export_format == 'tar' else MSGPACK_CONTENT_TYPE
+            return self._export_slice(start_row, stop_row, columns, export_format, max_rows, max_bytes, exclude_row)
+        raw = accepts_msgpack()
+        if params.get('stream') == '1' or 'application/x-ndjson' in bottle.request.headers.get('Accept', ''):
+            # NOTE: Streamed slices have no row/byte limits unless they are given
+            max_rows = int(params['maxRows']) if 'maxRows' in params else None
+            max_bytes = int(params['maxBytes']) if 'maxBytes' in params else None
+            bottle.response.headers["Content-type"] = MSGPACK_CONTENT_TYPE if raw else "application/x-ndjson"
+            return self._get_slice_stream(start_row, stop_row, columns, max_rows, max_bytes,
+                                          bool(int(params.get('excludeStart', 0))), raw)
         max_rows = min(10000, int(params.get('maxRows', 1)))
         print('MaxRows[%d]' % max_rows)
         max_bytes = min(5242880, int(params.get('maxBytes', 5242880)))
@@ -564,7 +857,7 @@ class DataHBaseTable(HBaseTable):
             for row_num, (cur_row, cur_columns) in enumerate(scanner, 1):
                 if exclude_start and row_num == 1:
                     continue
-                out.append(encode_row(cur_row, cur_columns))
+                out.append(encode_row(cur_row, cur_columns, raw))
                 cur_byte_count = self._byte_count_rows(out[-1:])
                 byte_count += cur_byte_count
                 # Compute the number of rows we should try to get by using the max sized row
@@ -573,8 +866,7 @@ class DataHBaseTable(HBaseTable):
                 per_call = max(1, min((max_bytes - byte_count) / max_byte_count, max_rows - len(out)))
                 if len(out) >= max_rows or byte_count >= max_bytes:
                     break
-        bottle.response.headers["Content-type"] = "application/json"
-        return json.dumps(out)
+        return dumps_response(out, raw)
 
     def patch_slice(self, start_row, stop_row, params, files):
         if files:
@@ -588,8 +880,9 @@ class DataHBaseTable(HBaseTable):
             self._column_write_validate(x)
         if mutations:
             with thrift_lock() as thrift:
-                for row, _ in thrift.scanner(self.table, start_row=start_row, stop_row=stop_row, keys_only=True):
-                    thrift.mutate_row(self.table, row, mutations)
+                with thrift.mutator() as mutator:
+                    for row, _ in thrift.scanner(self.table, start_row=start_row, stop_row=stop_row, keys_only=True, per_call=1000):
+                        mutator.mutate_row(self.table, row, mutations)
         return {}
 
     def delete_slice(self, start_row, stop_row):
@@ -597,8 +890,9 @@ class DataHBaseTable(HBaseTable):
         # NOTE: This only fetches rows that have a column in data:image (it is a significant optimization)
         # NOTE: Only parameters allowed, no "files" due to memory restrictions
         with thrift_lock() as thrift:
-            for row, _ in thrift.scanner(self.table, start_row=start_row, stop_row=stop_row, keys_only=True):
-                thrift.delete_row(self.table, row)
+            with thrift.mutator() as mutator:
+                for row, _ in thrift.scanner(self.table, start_row=start_row, stop_row=stop_row, keys_only=True, per_call=1000):
+                    mutator.delete_row(self.table, row)
         return {}
 
 
@@ -614,6 +908,41 @@ class ImagesHBaseTable(DataHBaseTable):
             return
         bottle.abort(403)
 
+    def patch_rows(self, body):
+        # Body is consecutive msgpack [row, {column: value}] pairs (binary, no b64), each row is
+        # validated separately and the valid ones are written in batches.  Returns the status of each row.
+        # NOTE: Bottle has already buffered the body (in memory up to MEMFILE_MAX, else a temp file), it is only parsed incrementally
+        raw = accepts_msgpack()
+        prefix_index = self._prefix_index('rw')
+        unpacker = msgpack.Unpacker()
+        out = []
+        with thrift_lock() as thrift:
+            with thrift.mutator() as mutator:
+                for chunk in iter(lambda: body.read(65536), ''):
+                    unpacker.feed(chunk)
+                    for row_columns in unpacker:
+                        try:
+                            row, columns = row_columns
+                        except (TypeError, ValueError):
+                            bottle.abort(400, 'Rows must be [row, {column: value}]')
+                        if not isinstance(row, str) or not isinstance(columns, dict):
+                            bottle.abort(400, 'Rows must be [row, {column: value}]')
+                        status = 200
+                        try:
+                            # NOTE: Checked per row so a bad one can't fail a batch write after earlier batches were flushed
+                            if not all(isinstance(x, str) and isinstance(y, str) for x, y in columns.items()):
+                                bottle.abort(400)
+                            if not prefix_index.contains_row(row):
+                                bottle.abort(401)
+                            for column in columns:
+                                self._column_write_validate(column)
+                        except bottle.HTTPError, e:
+                            status = e.status_code
+                        if status == 200 and columns:
+                            mutator.mutate_row(self.table, row, columns)
+                        out.append({'row': row if raw else base64.b64encode(row), 'status': status})
+        return dumps_response(out, raw)
+
     def post_row(self, row, params, files):
         if files:
             bottle.abort(400, 'Table does not support files')
@@ -628,19 +957,13 @@ class ImagesHBaseTable(DataHBaseTable):
                     self._row_validate(row, 'rw')
                 else:
                     self._row_validate(row, 'r')
-                if action.endswith('/link'):
-                    chain_input, model_link = _takeout_input_model_link_from_key(manager, model_key)
-                    binary_input = thrift.get_column(self.table, row, chain_input)
-                    model = picarus_takeout.ModelChain(msgpack.dumps([model_link]))
-                else:
-                    chain_inputs, model_chain = zip(*_takeout_input_model_chain_from_key(manager, model_key))
-                    binary_input = thrift.get_column(self.table, row, chain_inputs[0])
-                    model = picarus_takeout.ModelChain(msgpack.dumps(list(model_chain)))
-                bottle.response.headers["Content-type"] = "application/json"
+                chain_input, model = _takeout_model_from_key(manager, model_key, action.split('/')[1])
+                binary_input = thrift.get_column(self.table, row, chain_input)
                 model_out = model.process_binary(binary_input)
                 if write_result:
                     thrift.mutate_row(self.table, row, {model_key: model_out})
-                return json.dumps({base64.b64encode(model_key): base64.b64encode(model_out)})
+                raw = accepts_msgpack()
+                return dumps_response(encode_columns({model_key: model_out}, raw), raw)
             elif action in ('io/thumbnail', 'i/thumbnail'):
                 # TODO: Refactor this, it shares code with link/chain
                 write_result = action.startswith('io/')
@@ -648,22 +971,21 @@ class ImagesHBaseTable(DataHBaseTable):
                     self._row_validate(row, 'rw')
                 else:
                     self._row_validate(row, 'r')
-                # Makes 150x150 thumbnails from the data:image column
-                model_chain = [{'name': 'picarus.ImagePreprocessor', 'kw': {'method': 'force_square', 'size': 150, 'compression': 'jpg'}}]
-                model = picarus_takeout.ModelChain(msgpack.dumps(list(model_chain)))
-                bottle.response.headers["Content-type"] = "application/json"
+                model = _thumbnail_model()
                 model_out = model.process_binary(thrift.get_column(self.table, row, 'data:image'))
                 if write_result:
                     thrift.mutate_row(self.table, row, {'thum:image_150sq': model_out})
-                return json.dumps({base64.b64encode('thum:image_150sq'): base64.b64encode(model_out)})
+                raw = accepts_msgpack()
+                return dumps_response(encode_columns({'thum:image_150sq': model_out}, raw), raw)
             else:
                 bottle.abort(400, 'Invalid parameter value [action]')
 
     def post_slice(self, start_row, stop_row, params, files):
-        if files:
-            bottle.abort(400, 'Table does not support files')
         params = dict((k, base64.b64decode(v)) for k, v in params.items())
         action = params['action']
+        # NOTE: The only file allowed is the archive for o/import/archive
+        if files and (action != 'o/import/archive' or set(files) != set(['archive'])):
+            bottle.abort(400, 'Table does not support files')
         with thrift_lock() as thrift:
             manager = PicarusManager(db=thrift)
             if action == 'io/thumbnail':
@@ -734,6 +1056,35 @@ class ImagesHBaseTable(DataHBaseTable):
                                                               'action': action}, {})
                 thrift.street_view_job(params, start_row, stop_row, job_row)
                 return dict((base64.b64encode(k), base64.b64encode(v)) for k, v in {'row': job_row, 'table': 'jobs'}.items())
+            elif action == 'o/import/archive':
+                self._slice_validate(start_row, stop_row, 'w')
+                # Only slices where the start_row can be used as a prefix may be used
+                if not (start_row and ord(start_row[-1]) != 255 and start_row[:-1] + chr(ord(start_row[-1]) + 1) == stop_row):
+                    bottle.abort(400, 'Slice must be a prefix')
+                # NOTE: Small archives (<= 64KB) are sent by the client as a parameter instead of a file
+                uploaded = 'archive' in files or 'archive' in params
+                if uploaded:
+                    # NOTE: Uploads are spooled to disk and imported by the background job like a path, decompressing
+                    # and hashing here would stall the server.  Without --import_root the workers must share the temp dir.
+                    with tempfile.NamedTemporaryFile(dir=IMPORT_ROOT, prefix='.upload-', delete=False) as fp:
+                        if 'archive' in files:
+                            shutil.copyfileobj(files['archive'].file, fp, 1048576)
+                        else:
+                            fp.write(params['archive'])
+                    path = fp.name
+                else:
+                    if IMPORT_ROOT is None or 'path' not in params:
+                        bottle.abort(400, 'Missing parameter [archive]')
+                    import_root = os.path.realpath(IMPORT_ROOT)
+                    path = os.path.realpath(os.path.join(import_root, params['path']))
+                    if not path.startswith(import_root + '/') or not os.path.isfile(path):
+                        bottle.abort(403)
+                job_row = JOBS.add_task('import', self.owner, {'startRow': base64.b64encode(start_row),
+                                                               'stopRow': base64.b64encode(stop_row),
+                                                               'table': self.table,
+                                                               'action': action}, {})
+                thrift.import_archive_path_job(path, start_row, job_row, delete=uploaded)
+                return dict((base64.b64encode(k), base64.b64encode(v)) for k, v in {'row': job_row, 'table': 'jobs'}.items())
             else:
                 bottle.abort(400, 'Invalid parameter value [action]')
 
@@ -763,6 +1114,18 @@ class ModelsHBaseTable(HBaseTable):
             return
         bottle.abort(403)
 
+    def patch_row(self, row, params, files):
+        _invalidate_model(row)
+        return super(ModelsHBaseTable, self).patch_row(row, params, files)
+
+    def delete_row(self, row):
+        _invalidate_model(row)
+        return super(ModelsHBaseTable, self).delete_row(row)
+
+    def delete_column(self, row, column):
+        _invalidate_model(row)
+        return super(ModelsHBaseTable, self).delete_column(row, column)
+
     def _row_validate(self, row, permissions, thrift):
         try:
             results = thrift.get_column(self.table, row, 'user:' + self.owner)
@@ -775,6 +1138,7 @@ class ModelsHBaseTable(HBaseTable):
         user_column = 'user:' + self.owner
         output_user = user_column in columns or not columns or 'user:' in columns
         outs = []
+        raw = accepts_msgpack()
         if columns:
             columns = columns + [user_column]
         else:
@@ -784,9 +1148,8 @@ class ModelsHBaseTable(HBaseTable):
                 self._row_validate(row, 'r', thrift)
                 if not output_user:
                     del cols[user_column]
-                outs.append(encode_row(row, cols))
-        bottle.response.headers["Content-type"] = "application/json"
-        return json.dumps(outs)
+                outs.append(encode_row(row, cols, raw))
+        return dumps_response(outs, raw)
 
     def post_table(self, params, files):
         if files:
@@ -10,8 +10,47 @@ import argparse
 import json
 import logging
 import re
+import collections
+import math
+import bisect
 
 DEFAULT_TTL = 31536000
+# Latency histograms, one hash per user per period with fields "<method> <path>|<status>|<bucket>"
+USAGE_HIST_MIN = .0001  # Upper bound (sec) of bucket 0
+USAGE_HIST_RATIO = 2 ** .25  # Upper bound of bucket b is USAGE_HIST_MIN * USAGE_HIST_RATIO ** b (~19% resolution)
+USAGE_HIST_PERIOD = 3600
+USAGE_HIST_TTL = 90 * 86400
+INVALIDATE_CHANNEL = 'users:invalidate'  # Emails are published here when their keys/prefixes change
+_ROUTE_WILDCARD = re.compile('<([a-zA-Z_][a-zA-Z_0-9]*)[^>]*>')
+_ROUTE_PATHS = {}  # [(rule, version, table_name)] = path
+
+
+def route_path():
+    """Path of the matched route with wildcards as :name, e.g., /v0/data/images/:row
+
+    The version and table are kept (annotation tables have their task replaced with *).
+    """
+    url_args = bottle.request.url_args
+    key = (bottle.request.route.rule, url_args.get('version'), url_args.get('table_name'))
+    try:
+        return _ROUTE_PATHS[key]
+    except KeyError:
+        pass
+
+    def sub(match):
+        name = match.group(1)
+        if name not in ('version', 'table_name'):
+            return ':' + name
+        value = url_args[name]
+        for prefix in ('annotations-results-', 'annotations-users-'):
+            if value.startswith(prefix):
+                return prefix + '*'
+        return value
+    path = _ROUTE_WILDCARD.sub(sub, key[0])
+    # NOTE: Table names come from the user, don't let them grow this without bound
+    if len(_ROUTE_PATHS) < 10000:
+        _ROUTE_PATHS[key] = path
+    return path
 
 
 def email_auth_factory(email_auth_fn='email_auth.js'):
@@ -52,6 +91,100 @@ def email_auth_factory(email_auth_fn='email_auth.js'):
     return email_func
 
 
+def _latency_bucket(latency):
+    if latency <= USAGE_HIST_MIN:
+        return 0
+    return int(math.ceil(math.log(latency / USAGE_HIST_MIN, USAGE_HIST_RATIO)))
+
+
+def _bucket_latency(bucket):
+    return USAGE_HIST_MIN * USAGE_HIST_RATIO ** bucket
+
+
+def _usage_hist_key(email, period):
+    return '%s%s:%d' % (User._usage_hist_prefix, email, period)
+
+
+def _write_usage(pipe, email, usage):
+    counts = collections.Counter((int(x['startTime'] // USAGE_HIST_PERIOD),
+                                  '%s %s|%d|%d' % (x['method'], x['pathSanitized'], x['status_code'], _latency_bucket(x['time'])))
+                                 for x in usage)
+    for (period, field), count in counts.items():
+        pipe.hincrby(_usage_hist_key(email, period), field, count)
+    # NOTE: Old periods expire on their own, User.delete removes the rest
+    for period in set(x[0] for x in counts):
+        pipe.expire(_usage_hist_key(email, period), USAGE_HIST_TTL)
+
+
+class UsersCache(object):
+    """In-process cache of per-user values (verified API keys, prefixes) that expire after ttl seconds
+
+    All of a user's entries are dropped by invalidate(email).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._cache = {}  # [email][key] = (expiration, value)
+
+    def get(self, email, key):
+        try:
+            expiration, value = self._cache[email][key]
+        except KeyError:
+            return None
+        if expiration < time.time():
+            return None
+        return value
+
+    def put(self, email, key, value):
+        self._cache.setdefault(email, {})[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, email):
+        self._cache.pop(email, None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class PrefixIndex(object):
+    """Row prefixes with a set of permissions as sorted disjoint intervals, checks are O(log n)"""
+
+    def __init__(self, prefixes, permissions):
+        permissions = set(permissions)
+        prefixes = [x for x, y in prefixes.items() if set(y).issuperset(permissions)]
+        self.allow_all = '' in prefixes
+        intervals = []
+        for prefix in sorted(x for x in prefixes if x):
+            # NOTE: Prevents rollover, minor limitation on prefix is that it must not end in \xff
+            assert prefix[-1] != '\xff'
+            prefix_stop_row = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            # NOTE: Prefix intervals are either nested or disjoint, nested ones are already covered
+            if intervals and prefix < intervals[-1][1]:
+                continue
+            intervals.append((prefix, prefix_stop_row))
+        self.start_rows = [x for x, _ in intervals]
+        self.stop_rows = [x for _, x in intervals]
+
+    def _interval(self, row):
+        # Index of the interval that could contain row (the last one starting at or before it), -1 if none
+        return bisect.bisect_right(self.start_rows, row) - 1
+
+    def contains_row(self, row):
+        if self.allow_all:
+            return True
+        if not row:
+            return False
+        num = self._interval(row)
+        return num >= 0 and row < self.stop_rows[num]
+
+    def contains_slice(self, start_row, stop_row):
+        if self.allow_all:
+            return True
+        if not start_row or not stop_row:
+            return False
+        num = self._interval(start_row)
+        return num >= 0 and start_row < self.stop_rows[num] and self.start_rows[num] <= stop_row <= self.stop_rows[num]
+
+
 class UnknownUser(Exception):
     """User not in the database"""
 
@@ -62,13 +195,16 @@ class User(object):
     Public Methods: Safe to use from frontend
     Private Methods: Should not be used in frontend
     """
+    _usage_prefix = 'usage:'
+    _usage_hist_prefix = 'usage_hist:'
 
-    def __init__(self, user_db, email, setup=False):
+    def __init__(self, user_db, email, setup=False, usage_queue=None, cache=None):
         self._user_db = user_db
+        self._usage_queue = usage_queue  # If set, usage is appended as (email, data) and written by Users.flush_usage
+        self._cache = cache  # If set, a UsersCache
         self.email = email
         self.upload_row_prefix = 'userupload%s:' % base64.urlsafe_b64encode(hashlib.sha1(email).digest())[:-1]
         self._user_prefix = 'user:'
-        self._usage_prefix = 'usage:'
         self._api_key_prefix = 'auth:'
         self._login_key_prefix = 'login:'
         self._enabled_col = 'enabled'
@@ -78,9 +214,19 @@ class User(object):
         assert self.key_length > 0
         if setup:
             self.enable()
+        if self._cache is not None and self._cache.get(self.email, 'exists'):
+            return
         if not self._exists():
             raise UnknownUser
         self._user_db.delete('stat:' + self.email)
+        if self._cache is not None:
+            self._cache.put(self.email, 'exists', True)
+
+    def _invalidate(self):
+        # Drops cached keys/prefixes here and in other processes (see Users.cache_invalidator)
+        if self._cache is not None:
+            self._cache.invalidate(self.email)
+        self._user_db.publish(INVALIDATE_CHANNEL, self.email)
 
     def _exists(self):
         return self._user_db.exists(self._user_prefix + self.email) == 1
@@ -110,10 +256,15 @@ class User(object):
         self.hset('last_email', str(time.time()))
 
     def delete(self):
+        # NOTE: Only periods within USAGE_HIST_TTL can still exist, the usage list is from before the histograms
+        cur_period = int(time.time() // USAGE_HIST_PERIOD)
+        usage_hist_keys = [_usage_hist_key(self.email, x) for x in range(cur_period - USAGE_HIST_TTL // USAGE_HIST_PERIOD - 1, cur_period + 2)]
         self._user_db.delete(self._user_prefix + self.email,
                              self._usage_prefix + self.email,
                              self._api_key_prefix + self.email,
-                             self._login_key_prefix + self.email)
+                             self._login_key_prefix + self.email,
+                             *usage_hist_keys)
+        self._invalidate()
 
     def hset(self, key, val):
         return self._user_db.hset(self._user_prefix + self.email, key, val)
@@ -128,6 +279,7 @@ class User(object):
         cur_time = time.time()
         self._user_db.zremrangebyscore(k, -float('inf'), cur_time)
         self._user_db.zadd(k, str(cur_time + ttl), self._hash_key(key))
+        self._invalidate()
         return key
 
     def create_login_key(self, key=None):
@@ -149,9 +301,11 @@ class User(object):
 
     def add_prefix(self, table, prefix, permissions):
         self._user_db.hset(self._table_prefix(table) + self.email, prefix, permissions)
+        self._invalidate()
 
     def remove_prefix(self, table, prefix):
         self._user_db.hdel(self._table_prefix(table) + self.email, prefix)
+        self._invalidate()
 
     def add_project(self, table, project, slices):
         self._user_db.hset(self._table_project(table) + self.email, project, slices)
@@ -160,41 +314,71 @@ class User(object):
         self._user_db.hdel(self._table_project(table) + self.email, project)
 
     def prefixes(self, table):
-        return self._user_db.hgetall(self._table_prefix(table) + self.email)
+        if self._cache is not None:
+            out = self._cache.get(self.email, ('prefixes', table))
+            if out is not None:
+                return dict(out)
+        out = self._user_db.hgetall(self._table_prefix(table) + self.email)
+        if self._cache is not None:
+            self._cache.put(self.email, ('prefixes', table), out)
+        return dict(out)
+
+    def prefix_index(self, table, permissions):
+        if self._cache is not None:
+            out = self._cache.get(self.email, ('prefix_index', table, permissions))
+            if out is not None:
+                return out
+        out = PrefixIndex(self.prefixes(table), permissions)
+        if self._cache is not None:
+            self._cache.put(self.email, ('prefix_index', table, permissions), out)
+        return out
 
     def projects(self, table):
         return self._user_db.hgetall(self._table_project(table) + self.email)
 
-    def usage(self):
+    def usage(self, start_time=None, stop_time=None):
+        # Latency percentiles/status counts from the histograms of the periods overlapping [start_time, stop_time]
+        if stop_time is None:
+            stop_time = time.time()
+        if start_time is None:
+            start_time = stop_time - 7 * 86400
+        if any(math.isnan(x) or math.isinf(x) for x in (start_time, stop_time)) or start_time > stop_time:
+            raise ValueError('Invalid usage window')
+        # Older periods have expired, this also bounds the number of periods read
+        start_time = max(start_time, stop_time - USAGE_HIST_TTL)
+        pipe = self._user_db.pipeline(transaction=False)
+        for period in range(int(start_time // USAGE_HIST_PERIOD), int(stop_time // USAGE_HIST_PERIOD) + 1):
+            pipe.hgetall(_usage_hist_key(self.email, period))
         out = {}
-        for data in self._user_db.lrange(self._usage_prefix + self.email, 0, -1):
-            data = json.loads(data)
-            k = '%s %s' % (data['method'], data['pathSanitized'])
-            # Fix issues where the data is not ascii, e.g., invalid table value
-            try:
-                k.decode('ascii')
-            except UnicodeEncodeError:
-                continue
-            row = out.setdefault(k, {'times': []})
-            status_code_key = 'status:%d' % data['status_code']
-            try:
-                row[status_code_key] += 1
-            except KeyError:
-                row[status_code_key] = 1
-            row['times'].append(data['time'])
-        for k, v in out.items():
-            n = len(v['times'])
-            v['times'].sort()
-
-            def pct(x):
-                # Ensure that we even have data in that segment
-                if len(v['times']) < 1. / (1. - x / 100.):
-                    return
-                v['time:%dth' % x] = v['times'][min(int(round(n * x / 100.)), n - 1)]
+        hists = {}  # [k][bucket] = count
+        for hist in pipe.execute():
+            for field, count in hist.items():
+                k, status_code, bucket = field.rsplit('|', 2)
+                # Fix issues where the data is not ascii, e.g., invalid table value
+                try:
+                    k.decode('ascii')
+                except UnicodeDecodeError:
+                    continue
+                count = int(count)
+                row = out.setdefault(k, {})
+                status_code_key = 'status:' + status_code
+                row[status_code_key] = row.get(status_code_key, 0) + count
+                cur_hist = hists.setdefault(k, {})
+                cur_hist[int(bucket)] = cur_hist.get(int(bucket), 0) + count
+        for k, hist in hists.items():
+            n = sum(hist.values())
+            buckets = sorted(hist.items())
             for x in [50, 80, 90, 95, 99]:
-                pct(x)
-            del v['times']
-        print(out)
+                # Ensure that we even have data in that segment
+                if n < 1. / (1. - x / 100.):
+                    continue
+                rank = min(int(round(n * x / 100.)), n - 1) + 1
+                total = 0
+                for bucket, count in buckets:
+                    total += count
+                    if total >= rank:
+                        out[k]['time:%dth' % x] = _bucket_latency(bucket)
+                        break
         return out
 
     @property
@@ -202,49 +386,27 @@ class User(object):
         return self._user_db.get(self._login_key_prefix + self.email)
 
     def verify_api_key(self, key):
+        hashed_key = self._hash_key(key)
+        if self._cache is not None:
+            expiration = self._cache.get(self.email, ('api_key', hashed_key))
+            if expiration is not None and expiration > time.time():
+                return True
         k = self._api_key_prefix + self.email
         self._user_db.zremrangebyscore(k, -float('inf'), time.time())
-        out = self._user_db.zscore(k, self._hash_key(key))
-        return out is not None
+        out = self._user_db.zscore(k, hashed_key)
+        if out is None:
+            return False
+        if self._cache is not None:
+            self._cache.put(self.email, ('api_key', hashed_key), float(out))
+        return True
 
     def verify_login_key(self, key):
         return self.login_key == self._hash_key(key)
 
-    def _sanitize_path(self):
-        path = bottle.request.path
-        try:
-            match = re.finditer('/[^/]+/data/annotations\-results\-([^/]+)', path).next()
-            regs = match.regs[1]
-            path = '%s*%s' % (path[:regs[0]], path[regs[1]:])
-        except StopIteration:
-            pass
-        try:
-            match = re.finditer('/[^/]+/data/annotations\-users\-([^/]+)', path).next()
-            regs = match.regs[1]
-            path = '%s*%s' % (path[:regs[0]], path[regs[1]:])
-        except StopIteration:
-            pass
-        r = re.search('(/[^/]+/data/[^/]+)', path)
-        if r:
-            return r.group(1)
-        r = re.search('(/[^/]+/data/[^/]+/)[^/]+', path)
-        if r:
-            return r.group(1) + ':row'
-        r = re.search('(/[^/]+/data/[^/]+/)[^/]+/[^/]+', path)
-        if r:
-            return r.group(1) + ':row/:column'
-        r = re.search('(/[^/]+/slice/[^/]+/)[^/]+/[^/]+', path)
-        if r:
-            return r.group(1) + ':startRow/:stopRow'
-        return bottle.request.path
-
     @contextlib.contextmanager
     def _api_stats(self):
-        path_sanitized = self._sanitize_path()
-        out = {'method': bottle.request.method, 'path': bottle.request.path}
-        if path_sanitized:
-            out['pathSanitized'] = path_sanitized
         st = time.time()
+        out = {'method': bottle.request.method, 'path': bottle.request.path, 'pathSanitized': route_path(), 'startTime': st}
         status_code = 200
         try:
             yield
@@ -254,8 +416,12 @@ class User(object):
         finally:
             out['time'] = time.time() - st
             out['status_code'] = status_code
-            self._user_db.lpush(self._usage_prefix + self.email, json.dumps(out))
-            self._user_db.ltrim(self._usage_prefix + self.email, 0, 10000)
+            if self._usage_queue is not None:
+                self._usage_queue.append((self.email, out))
+            else:
+                pipe = self._user_db.pipeline(transaction=False)
+                _write_usage(pipe, self.email, [out])
+                pipe.execute()
 
     def _key_gen(self):
         # Replaces +/ with ab so that keys are easily selected, can compensate with keylength
@@ -267,9 +433,50 @@ class User(object):
 
 class Users(object):
 
-    def __init__(self, host, port, db):
+    def __init__(self, host, port, db, usage_interval=None, cache_ttl=None):
         self.user_db = redis.StrictRedis(host=host, port=port, db=db)
         self.email_func = email_auth_factory()
+        # If cache_ttl is set, verified API keys and prefixes are kept in memory (see cache_invalidator)
+        self.cache = UsersCache(cache_ttl) if cache_ttl else None
+        # If usage_interval is set, API usage is queued and written every usage_interval seconds by usage_flusher
+        self.usage_interval = usage_interval
+        self._usage_queue = collections.deque() if usage_interval else None
+
+    def flush_usage(self):
+        usage = collections.OrderedDict()
+        while self._usage_queue:
+            email, data = self._usage_queue.popleft()
+            usage.setdefault(email, []).append(data)
+        if not usage:
+            return
+        pipe = self.user_db.pipeline(transaction=False)
+        for email, cur_usage in usage.items():
+            _write_usage(pipe, email, cur_usage)
+        pipe.execute()
+
+    def cache_invalidator(self):
+        # Run in a background greenlet, drops cached entries of users changed by other processes
+        while 1:
+            try:
+                pubsub = self.user_db.pubsub()
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.cache.invalidate(message['data'])
+            except redis.RedisError:
+                logging.exception('Lost the user invalidation channel')
+            # NOTE: Invalidations may have been missed
+            self.cache.clear()
+            time.sleep(1.)
+
+    def usage_flusher(self):
+        # Run in a background greenlet
+        while 1:
+            time.sleep(self.usage_interval)
+            try:
+                self.flush_usage()
+            except redis.RedisError:
+                logging.exception('Could not write API usage')
 
     def add_user(self, email):
         return User(self.user_db, email, setup=True)
@@ -287,7 +494,7 @@ class Users(object):
         return list(set(x.split(':')[1] for x in self.user_db.keys()))
 
     def get_user(self, email):
-        return User(self.user_db, email)
+        return User(self.user_db, email, usage_queue=self._usage_queue, cache=self.cache)
 
     def verify_api_user(self):
         if bottle.request.auth is None:
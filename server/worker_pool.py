@@ -0,0 +1,102 @@
+import collections
+import traceback
+import gevent.pool
+import gevent.queue
+import gipc
+
+
+class WorkerError(Exception):
+    """Exception raised by the function in a worker process"""
+
+
+def _worker(handle, func):
+    while True:
+        try:
+            args = handle.get()
+        except EOFError:
+            break
+        if args is None:
+            break
+        try:
+            handle.put((True, func(*args)))
+        except Exception:
+            handle.put((False, traceback.format_exc()))
+    handle.close()
+
+
+class WorkerPool(object):
+    """Pool of worker processes that run func, callers wait cooperatively (gevent)
+
+    The workers are forked so func may be a closure (e.g., holding a loaded
+    model) and it is never pickled, only the arguments and results are.
+    """
+
+    def __init__(self, num_workers, func):
+        self.num_workers = num_workers
+        self._func = func
+        self._processes = {}  # [handle] = process
+        self._handles = gevent.queue.Queue()
+        for x in range(num_workers):
+            self._handles.put(self._start_worker())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start_worker(self):
+        handle, child_handle = gipc.pipe(duplex=True)
+        # NOTE: gipc closes child_handle in this process once the worker starts
+        self._processes[handle] = gipc.start_process(_worker, args=(child_handle, self._func), daemon=True)
+        return handle
+
+    def _replace_worker(self, handle):
+        process = self._processes.pop(handle, None)
+        try:
+            handle.close()
+        except (IOError, OSError):
+            pass
+        if process is None:  # Pool was closed
+            return
+        process.terminate()
+        process.join()
+        self._handles.put(self._start_worker())
+
+    def apply(self, *args):
+        handle = self._handles.get()
+        try:
+            handle.put(args)
+            success, out = handle.get()
+        except BaseException:
+            # NOTE: The worker died or the caller was killed (its late reply would go to the next caller),
+            # either way the handle can't be reused so the worker is replaced
+            self._replace_worker(handle)
+            raise
+        self._handles.put(handle)
+        if not success:
+            raise WorkerError(out)
+        return out
+
+    def imap(self, args_iter, max_pending=None):
+        # Yields results in the order of args_iter, with at most max_pending outstanding
+        if max_pending is None:
+            max_pending = 4 * self.num_workers
+        pool = gevent.pool.Pool(self.num_workers)
+        pending = collections.deque()
+        for args in args_iter:
+            while len(pending) >= max_pending:
+                yield pending.popleft().get()
+            pending.append(pool.spawn(self.apply, *args))
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        processes, self._processes = self._processes, {}
+        for handle, process in processes.items():
+            try:
+                handle.put(None)
+            except (IOError, OSError):
+                pass
+            handle.close()
+            process.join()
@@ -3,27 +3,83 @@ import picarus
 import glob
 import base64
 import os
+import collections
+import multiprocessing.pool
 
 
-def main(email, table, prefix, path, picarus_server, api_key=None, login_key=None, otp=None, start_row=''):
-    path = os.path.abspath(path)
-    if otp:
-        api_key = picarus.PicarusClient(email=email, login_key=login_key, server=picarus_server).auth_yubikey(otp)['apiKey']
-    if api_key is None:
-        raise ValueError('api_key or login_key/otp must be set!')
-    if start_row:
-        start_row = base64.urlsafe_b64decode(start_row)
-    client = picarus.PicarusClient(email=email, api_key=api_key, server=picarus_server)
+def read_batches(path, prefix, start_row, resume_row, batch_rows, batch_bytes):
+    batch = []
+    byte_count = 0
     for row_path in sorted(glob.glob(path + '/*')):
         row = prefix + base64.urlsafe_b64decode(os.path.basename(row_path))
-        if row < start_row:
+        if row < start_row or (resume_row is not None and row <= resume_row):
             continue
         columns = {}
         for column_path in glob.glob(row_path + '/*'):
             column = base64.urlsafe_b64decode(os.path.basename(column_path))
             columns[column] = open(column_path, 'rb').read()
-        print('Sending [%r] ub64:[%s] to Picarus' % (row, base64.urlsafe_b64encode(row)))
-        client.patch_row(table, row, columns)
+        batch.append((row, columns))
+        byte_count += sum(len(x) + len(y) for x, y in columns.items())
+        if len(batch) >= batch_rows or byte_count >= batch_bytes:
+            yield batch
+            batch = []
+            byte_count = 0
+    if batch:
+        yield batch
+
+
+def write_checkpoint(checkpoint, row):
+    # NOTE: Written then renamed so a crash never leaves a partial checkpoint
+    with open(checkpoint + '.tmp', 'w') as fp:
+        fp.write(base64.urlsafe_b64encode(row))
+    os.rename(checkpoint + '.tmp', checkpoint)
+
+
+def main(email, table, prefix, path, picarus_server, api_key=None, login_key=None, otp=None, start_row='',
+         checkpoint=None, batch_rows=100, batch_mb=16, concurrency=4):
+    path = os.path.abspath(path)
+    if otp:
+        api_key = picarus.PicarusClient(email=email, login_key=login_key, server=picarus_server).auth_yubikey(otp)['apiKey']
+    if api_key is None:
+        raise ValueError('api_key or login_key/otp must be set!')
+    if start_row:
+        start_row = base64.urlsafe_b64decode(start_row)
+    else:
+        start_row = ''
+    resume_row = None
+    if checkpoint and os.path.exists(checkpoint):
+        resume_row = base64.urlsafe_b64decode(open(checkpoint).read().strip())
+        print('Resuming after [%r] ub64:[%s]' % (resume_row, base64.urlsafe_b64encode(resume_row)))
+    client = picarus.PicarusClient(email=email, api_key=api_key, server=picarus_server, pool_size=concurrency)
+    pool = multiprocessing.pool.ThreadPool(concurrency)
+    # Batches finish out of order, the checkpoint only moves past a batch once all before it are done
+    pending = collections.deque()
+    # NOTE: After a row fails the checkpoint stops before it so a resume retries it (rows after it are resent)
+    failed = []
+
+    def finish(batch, result):
+        statuses = result.get()
+        for num, (row, status) in enumerate(statuses):
+            if status != 200:
+                print('Failed [%r] ub64:[%s] status[%d]' % (row, base64.urlsafe_b64encode(row), status))
+                if not failed:
+                    failed.append(row)
+                    if checkpoint and num:
+                        write_checkpoint(checkpoint, batch[num - 1][0])
+        print('Sent [%d] rows, last [%r] ub64:[%s]' % (len(batch), batch[-1][0], base64.urlsafe_b64encode(batch[-1][0])))
+        if checkpoint and not failed:
+            write_checkpoint(checkpoint, batch[-1][0])
+
+    for batch in read_batches(path, prefix, start_row, resume_row, batch_rows, batch_mb * 1024 ** 2):
+        while len(pending) >= concurrency:
+            finish(*pending.popleft())
+        pending.append((batch, pool.apply_async(client.patch_rows, (table, batch))))
+    while pending:
+        finish(*pending.popleft())
+    pool.close()
+    pool.join()
+    if failed:
+        print('Rows failed, the first was [%r] ub64:[%s] (rerun with the checkpoint or use it as --start_row)' % (failed[0], base64.urlsafe_b64encode(failed[0])))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Picarus bulk directory uploader.  Path points to a directory encoded as <path>/<ub64row>/<ub64col> for each column, with the file contents the binary column value (not encoded).  ub64 refers to urlsafe b64 encoding.  Rows uploaded in ascending lexical order.')
@@ -32,6 +88,10 @@ if __name__ == '__main__':
     parser.add_argument('prefix', help='Prefix added to each row (plaintext, not encoded)')
     parser.add_argument('path', help='Local path to the directory to upload')
     parser.add_argument('--start_row', help='Skip all rows before this, must include prefix and be ub64 encoded (useful for resuming, paste failed row here)')
+    parser.add_argument('--checkpoint', help='File storing the last row uploaded (ub64), if it exists then the upload resumes after that row')
+    parser.add_argument('--batch_rows', type=int, default=100, help='Max rows sent per request')
+    parser.add_argument('--batch_mb', type=int, default=16, help='Max size (MB) of the rows sent per request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of requests in flight')
     parser.add_argument('--api_key')
     parser.add_argument('--login_key')
     parser.add_argument('--otp')